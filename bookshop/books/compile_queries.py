@@ -0,0 +1,169 @@
+"""Microbenchmarks for the Djaq expression compiler.
+
+A corpus of representative queries is compiled to SQL without being
+executed, so we measure the cost of ``ExpressionParser.parse_source()``
+and ``build_sql_statement()`` separately from database time:
+
+    ./manage.py run --compile-only --output compile.json
+
+For each query we report compiles per second, the memory blocks a
+compile leaves allocated and the peak memory allocated by a single
+compile as traced by ``tracemalloc``. Blocks allocated and freed within
+a compile are not counted; ``tracemalloc`` only sees live blocks.
+
+"""
+
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import django
+
+from djaq import DjaqQuery as DQ, B
+from books.run_queries import git_commit
+
+DEFAULT_COMPILES = 2000
+
+
+def wide_select():
+    return DQ(
+        "Book",
+        """id, name, pages, price, rating, pubdate, in_print,
+        category, genre, publisher, alt_publisher,
+        price * 1.2 as gross, pages / 100 as hundreds,
+        publisher.name as publisher_name, alt_publisher.name as alt_name
+        """,
+    )
+
+
+def star_select():
+    return DQ("Book")
+
+
+def fk_chain():
+    return DQ(
+        "Book",
+        "name, publisher.name, publisher.owner.name, publisher.owner.marketcap",
+    ).where("publisher.owner.marketcap > 1000")
+
+
+def display_choices():
+    return DQ("Book", "name, genre_display, category_display")
+
+
+def condition_tree():
+    conditions = (
+        B("price > {min_price}")
+        & (B("rating >= 3") | B("pages < 300"))
+        & (B("in_print is True") | (B("genre == 'F'") & B("category == 'N'")))
+        & B("regex(name, {pattern})")
+    )
+    return DQ("Book", "id, name").where(conditions)
+
+
+def m2m_path():
+    return DQ("Book", "name, authors.name, authors.age").where("authors.age > 30")
+
+
+def named_subquery():
+    publishers = DQ("Publisher", "id").where("ilike(name, 'a%')")
+    return DQ(
+        "Book", "name, price", names={"compile_publishers": publishers.parser}
+    ).where("publisher in '@compile_publishers'")
+
+
+def aggregates():
+    return DQ(
+        "Book",
+        """publisher.name,
+        count(id) as num_books,
+        avg(price) as avg_price,
+        sumif(rating < 3, 1, 0) as below_3,
+        max(price) - avg(price) as price_diff
+        """,
+    ).order_by("publisher.name")
+
+
+CORPUS = {
+    "wide_select": wide_select,
+    "star_select": star_select,
+    "fk_chain": fk_chain,
+    "display_choices": display_choices,
+    "condition_tree": condition_tree,
+    "m2m_path": m2m_path,
+    "named_subquery": named_subquery,
+    "aggregates": aggregates,
+}
+
+
+def measure(name, compiles):
+    """Return a dict of compile measurements for the corpus query name."""
+    dq = CORPUS[name]()
+    # warm up caches like model meta lookups
+    dq.construct()
+
+    start = time.perf_counter()
+    for _ in range(compiles):
+        dq.construct()
+    elapsed = time.perf_counter() - start
+
+    traced = min(compiles, 20)
+    # tracemalloc's own allocations, like those of snapshots
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot().filter_traces(ignore)
+    for _ in range(traced):
+        dq.construct()
+    after = tracemalloc.take_snapshot().filter_traces(ignore)
+    tracemalloc.stop()
+    # live blocks, so what a compile retains, like caches and the SQL
+    retained = sum(stat.count for stat in after.statistics("filename")) - sum(
+        stat.count for stat in before.statistics("filename")
+    )
+
+    peaks = []
+    for _ in range(traced):
+        tracemalloc.start()
+        dq.construct()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak)
+
+    return {
+        "query": name,
+        "compiles": compiles,
+        "compiles_per_sec": compiles / elapsed,
+        "us_per_compile": elapsed / compiles * 1000000,
+        "retained_blocks_per_compile": retained / traced,
+        "peak_bytes_per_compile": statistics.median(peaks),
+        "sql_length": len(dq.parser.sql),
+    }
+
+
+def run(options):
+    """Compile the corpus and emit JSON."""
+    compiles = options.get("compiles") or DEFAULT_COMPILES
+    pattern = options.get("funcname")
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "results": [
+            measure(name, compiles)
+            for name in CORPUS
+            if not pattern or name.startswith(pattern)
+        ],
+    }
+
+    output = options.get("output")
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return report
@@ -1,9 +1,14 @@
+import csv
+import io
+import math
 import random
+from datetime import date, timedelta
 
 import factory
+from django.db import connections
 from faker import Faker
 
-from books.models import Author, Publisher, Book, Store
+from books.models import Author, Consortium, Publisher, Book, ISBN, Store
 
 fake = Faker()
 
@@ -12,15 +17,15 @@ class AuthorFactory(factory.Factory):
     class Meta:
         model = Author
 
-    name = fake.name()
-    age = random.choice(range(20, 80))
+    name = factory.Faker("name")
+    age = factory.LazyFunction(lambda: random.choice(range(20, 80)))
 
 
 class PublisherFactory(factory.Factory):
     class Meta:
         model = Publisher
 
-    name = fake.company()
+    name = factory.Faker("company")
 
 
 class BookFactory(factory.Factory):
@@ -30,11 +35,11 @@ class BookFactory(factory.Factory):
     name = factory.Faker("sentence", nb_words=4)
     # authors = factory.Iterator(Author.objects.all())
 
-    pages = random.choice(range(100, 800))
-    price = random.choice(range(3, 35))
-    rating = random.choice(range(5))
+    pages = factory.LazyFunction(lambda: random.choice(range(100, 800)))
+    price = factory.LazyFunction(lambda: random.choice(range(3, 35)))
+    rating = factory.LazyFunction(lambda: random.choice(range(5)))
     publisher = factory.Iterator(Publisher.objects.all())
-    pubdate = fake.date_this_century(before_today=True, after_today=False)
+    pubdate = factory.Faker("date_this_century", before_today=True, after_today=False)
 
     # @factory.post_generation
     # def authors(self, create, extracted, **kwargs):
@@ -49,7 +54,7 @@ class StoreFactory(factory.Factory):
     class Meta:
         model = Store
 
-    name = fake.company()
+    name = factory.Faker("company")
 
     # @factory.post_generation
     # def books(self, create, extracted, **kwargs):
@@ -59,7 +64,7 @@ class StoreFactory(factory.Factory):
     #             self.books.add(book)
 
 
-def build_data(book_count=None):
+def build_data(book_count=None, using="default"):
 
     authors = []
     publishers = []
@@ -72,48 +77,276 @@ def build_data(book_count=None):
     COUNT_STORES = book_count * 0.2
     COUNT_AUTHORS = book_count * 1.5
 
-    cnt = COUNT_AUTHORS - Author.objects.all().count()
+    cnt = COUNT_AUTHORS - Author.objects.using(using).all().count()
     while cnt > 0:
         cnt -= 1
-        author = AuthorFactory.create(
-            name=fake.name(), age=random.choice(range(20, 80))
-        ).save()
+        author = AuthorFactory.build(name=fake.name(), age=random.choice(range(20, 80)))
+        author.save(using=using)
         authors.append(author)
     else:
-        authors = list(Author.objects.all())
+        authors = list(Author.objects.using(using).all())
 
-    cnt = COUNT_PUBLISHERS - Publisher.objects.all().count()
+    cnt = COUNT_PUBLISHERS - Publisher.objects.using(using).all().count()
     while cnt > 0:
         cnt -= 1
-        publishers.append(PublisherFactory.create(name=fake.company()).save())
+        publisher = PublisherFactory.build(name=fake.company())
+        publisher.save(using=using)
+        publishers.append(publisher)
     else:
-        publishers = list(Publisher.objects.all())
+        publishers = list(Publisher.objects.using(using).all())
 
-    cnt = book_count - Book.objects.all().count()
+    cnt = book_count - Book.objects.using(using).all().count()
     while cnt > 0:
         cnt -= 1
         if not cnt % 1000:
             print(cnt)
-        book = BookFactory.create(
-            name=factory.Faker("sentence", nb_words=4),
+        book = BookFactory.build(
+            name=fake.sentence(nb_words=4),
             pages=random.choice(range(100, 800)),
             price=random.choice(range(3, 35)),
             rating=random.choice(range(5)),
-            publisher=Publisher.objects.all().order_by("?")[0],
+            publisher=Publisher.objects.using(using).all().order_by("?")[0],
             pubdate=fake.date_this_century(before_today=True, after_today=False),
         )
-        book.save()
-        authors = Author.objects.all().order_by("?")[:3]
+        book.save(using=using)
+        authors = Author.objects.using(using).all().order_by("?")[:3]
         for author in authors:
             book.authors.add(author)
     else:
-        books = list(Book.objects.all())
+        books = list(Book.objects.using(using).all())
 
-    cnt = COUNT_STORES - Store.objects.all().count()
+    cnt = COUNT_STORES - Store.objects.using(using).all().count()
     while cnt > 0:
         cnt -= 1
-        store = StoreFactory.create(name=fake.company())
-        store.save()
-        books = Book.objects.all().order_by("?")[:150]
+        store = StoreFactory.build(name=fake.company())
+        store.save(using=using)
+        books = Book.objects.using(using).all().order_by("?")[:150]
         for book in books:
             store.books.add(book)
+
+
+def zipf_weights(n, s):
+    """Return cumulative weights for ranks 1..n of a Zipf distribution."""
+    weights = []
+    total = 0.0
+    for rank in range(1, n + 1):
+        total += 1.0 / rank**s
+        weights.append(total)
+    return weights
+
+
+def fan_out(rng, mean, maximum):
+    """Return a geometric count >= 1 with the given mean, capped at maximum."""
+    if mean <= 1:
+        return 1
+    p = 1.0 / mean
+    return min(1 + int(math.log(1.0 - rng.random()) / math.log(1.0 - p)), maximum)
+
+
+def new_ids(model, using, max_id):
+    """Return ids of model rows inserted after max_id, in insertion order."""
+    return list(
+        model.objects.using(using)
+        .filter(id__gt=max_id)
+        .order_by("id")
+        .values_list("id", flat=True)
+    )
+
+
+def max_id(model, using):
+    return (
+        model.objects.using(using).order_by("-id").values_list("id", flat=True).first()
+        or 0
+    )
+
+
+def copy_rows(model, columns, rows, using):
+    """Insert rows into the table of model.
+
+    On Postgresql this uses COPY, otherwise bulk_create.
+
+    """
+    connection = connections[using]
+    if connection.vendor == "postgresql":
+        buf = io.StringIO()
+        csv.writer(buf).writerows(rows)
+        buf.seek(0)
+        statement = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+            connection.ops.quote_name(model._meta.db_table),
+            ", ".join(connection.ops.quote_name(c) for c in columns),
+        )
+        with connection.cursor() as cursor:
+            if hasattr(cursor, "copy_expert"):
+                # psycopg2
+                cursor.copy_expert(statement, buf)
+            else:
+                # psycopg 3
+                with cursor.copy(statement) as copy:
+                    copy.write(buf.read())
+    else:
+        model.objects.using(using).bulk_create(
+            [model(**dict(zip(columns, row))) for row in rows],
+            batch_size=500,
+        )
+
+
+def bulk_build_data(
+    book_count=None,
+    using="default",
+    batch_size=10000,
+    publisher_count=None,
+    consortium_count=None,
+    author_count=None,
+    store_count=None,
+    authors_per_book=2,
+    books_per_store=150,
+    zipf=1.1,
+    first_year=1950,
+    seed=None,
+    verbose=0,
+):
+    """Create data in batches with bulk_create and COPY.
+
+    Unlike build_data() this is fast enough to create millions of books
+    and the data has realistic distributions:
+
+    * publishers are Zipf distributed with exponent zipf so a few
+      publishers have most of the books, as are authors of books
+    * books have a geometric number of authors with mean authors_per_book
+    * publication dates span the decades since first_year, skewed to
+      recent years
+
+    Cardinalities default to a fraction of book_count. Like build_data()
+    only missing rows are created so the function can be called with
+    increasing book counts. ISBNs are created explicitly since
+    bulk_create does not send post_save signals.
+
+    """
+    rng = random.Random(seed)
+    if not book_count:
+        book_count = 1000
+    if publisher_count is None:
+        publisher_count = max(book_count // 100, 10)
+    if consortium_count is None:
+        consortium_count = max(publisher_count // 10, 1)
+    if author_count is None:
+        author_count = max(book_count // 2, 10)
+    if store_count is None:
+        store_count = max(book_count // 1000, 1)
+
+    # a pool of words is much faster than asking faker for every row
+    words = fake.words(nb=2000)
+    companies = [fake.company() for _ in range(1000)]
+    names = [fake.name() for _ in range(1000)]
+
+    def log(msg):
+        if verbose:
+            print(msg)
+
+    def create(model, count, make):
+        """Create missing rows of model with make(i) in batches."""
+        missing = count - model.objects.using(using).count()
+        while missing > 0:
+            size = min(missing, batch_size)
+            model.objects.using(using).bulk_create(
+                [make(i) for i in range(size)], batch_size=batch_size
+            )
+            missing -= size
+            log("{}: {} to go".format(model.__name__, missing))
+
+    create(
+        Consortium,
+        consortium_count,
+        lambda i: Consortium(
+            name=rng.choice(companies)[:30], marketcap=rng.randint(1000, 9999999)
+        ),
+    )
+    consortium_ids = list(Consortium.objects.using(using).values_list("id", flat=True))
+
+    create(
+        Publisher,
+        publisher_count,
+        lambda i: Publisher(
+            name=rng.choice(companies), owner_id=rng.choice(consortium_ids)
+        ),
+    )
+    create(
+        Author,
+        author_count,
+        lambda i: Author(name=rng.choice(names), age=int(rng.triangular(20, 90, 45))),
+    )
+
+    publisher_ids = list(Publisher.objects.using(using).values_list("id", flat=True))
+    author_ids = list(Author.objects.using(using).values_list("id", flat=True))
+    # random rank so popularity does not follow primary keys
+    rng.shuffle(publisher_ids)
+    rng.shuffle(author_ids)
+    publisher_weights = zipf_weights(len(publisher_ids), zipf)
+    author_weights = zipf_weights(len(author_ids), zipf)
+
+    today = date.today()
+    first_day = date(first_year, 1, 1)
+    span = (today - first_day).days
+    genres = [g for g, _ in Book._meta.get_field("genre").choices]
+    categories = [c for c, _ in Book._meta.get_field("category").choices]
+    authors_through = Book.authors.through
+
+    def make_book():
+        publisher_id, alt_publisher_id = rng.choices(
+            publisher_ids, cum_weights=publisher_weights, k=2
+        )
+        return Book(
+            name=" ".join(rng.sample(words, rng.randint(2, 6))).capitalize(),
+            pages=int(rng.lognormvariate(5.6, 0.4)) + 20,
+            price=round(rng.lognormvariate(2.7, 0.5), 2),
+            rating=round(rng.triangular(0, 5, 3.5), 1),
+            publisher_id=publisher_id,
+            alt_publisher_id=alt_publisher_id if rng.random() < 0.1 else None,
+            pubdate=first_day + timedelta(days=int(rng.triangular(0, span, span))),
+            in_print=rng.random() < 0.7,
+            category=rng.choice(categories),
+            genre=rng.choice(genres),
+        )
+
+    missing = book_count - Book.objects.using(using).count()
+    while missing > 0:
+        size = min(missing, batch_size)
+        last_id = max_id(Book, using)
+        Book.objects.using(using).bulk_create(
+            [make_book() for _ in range(size)], batch_size=batch_size
+        )
+        book_ids = new_ids(Book, using, last_id)
+
+        links = []
+        for book_id in book_ids:
+            count = fan_out(rng, authors_per_book, 20)
+            chosen = set(rng.choices(author_ids, cum_weights=author_weights, k=count))
+            links.extend((book_id, author_id) for author_id in chosen)
+        copy_rows(authors_through, ["book_id", "author_id"], links, using)
+        copy_rows(
+            ISBN,
+            ["book_id", "code"],
+            [
+                (book_id, "978-{:010d}".format(rng.randrange(10**10)))
+                for book_id in book_ids
+            ],
+            using,
+        )
+        missing -= size
+        log("Book: {} to go".format(missing))
+
+    missing = store_count - Store.objects.using(using).count()
+    if missing > 0:
+        last_id = max_id(Store, using)
+        create(Store, store_count, lambda i: Store(name=rng.choice(companies)))
+        all_book_ids = list(Book.objects.using(using).values_list("id", flat=True))
+        links = []
+        for store_id in new_ids(Store, using, last_id):
+            count = min(fan_out(rng, books_per_store, 10000), len(all_book_ids))
+            links.extend(
+                (store_id, book_id) for book_id in rng.sample(all_book_ids, count)
+            )
+            if len(links) >= batch_size:
+                copy_rows(Store.books.through, ["store_id", "book_id"], links, using)
+                links = []
+        copy_rows(Store.books.through, ["store_id", "book_id"], links, using)
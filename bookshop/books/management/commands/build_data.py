@@ -3,7 +3,7 @@ import traceback
 
 from django.core.management.base import BaseCommand, CommandError
 
-from books.data_factory import build_data
+from books.data_factory import build_data, bulk_build_data
 
 
 class Command(BaseCommand):
@@ -15,5 +15,105 @@ class Command(BaseCommand):
             "--book-count", default=1000, action="store", dest="book_count", type=int
         )
 
+        parser.add_argument(
+            "--database",
+            default="default",
+            action="store",
+            dest="database",
+            type=str,
+            help="Database alias to create data in",
+        )
+
+        parser.add_argument(
+            "--bulk",
+            default=False,
+            action="store_true",
+            dest="bulk",
+            help="Create data in batches with skewed distributions",
+        )
+
+        parser.add_argument(
+            "--batch-size", default=10000, action="store", dest="batch_size", type=int
+        )
+
+        parser.add_argument(
+            "--publisher-count",
+            default=None,
+            action="store",
+            dest="publisher_count",
+            type=int,
+        )
+
+        parser.add_argument(
+            "--consortium-count",
+            default=None,
+            action="store",
+            dest="consortium_count",
+            type=int,
+        )
+
+        parser.add_argument(
+            "--author-count",
+            default=None,
+            action="store",
+            dest="author_count",
+            type=int,
+        )
+
+        parser.add_argument(
+            "--store-count", default=None, action="store", dest="store_count", type=int
+        )
+
+        parser.add_argument(
+            "--authors-per-book",
+            default=2,
+            action="store",
+            dest="authors_per_book",
+            type=float,
+            help="Mean number of authors of a book",
+        )
+
+        parser.add_argument(
+            "--books-per-store",
+            default=150,
+            action="store",
+            dest="books_per_store",
+            type=float,
+            help="Mean number of books in a store",
+        )
+
+        parser.add_argument(
+            "--zipf",
+            default=1.1,
+            action="store",
+            dest="zipf",
+            type=float,
+            help="Zipf exponent for the popularity of publishers and authors",
+        )
+
+        parser.add_argument(
+            "--seed", default=None, action="store", dest="seed", type=int
+        )
+
+        parser.add_argument("--v", action="store", dest="verbose", default=0, type=int)
+
     def handle(self, *args, **options):
-        build_data(book_count=options.get("book_count"))
+        if options.get("bulk"):
+            bulk_build_data(
+                book_count=options.get("book_count"),
+                using=options.get("database"),
+                batch_size=options.get("batch_size"),
+                publisher_count=options.get("publisher_count"),
+                consortium_count=options.get("consortium_count"),
+                author_count=options.get("author_count"),
+                store_count=options.get("store_count"),
+                authors_per_book=options.get("authors_per_book"),
+                books_per_store=options.get("books_per_store"),
+                zipf=options.get("zipf"),
+                seed=options.get("seed"),
+                verbose=options.get("verbose"),
+            )
+        else:
+            build_data(
+                book_count=options.get("book_count"), using=options.get("database")
+            )
@@ -1,24 +1,79 @@
-import sys
-import traceback
+from django.core.management.base import BaseCommand
 
-from django.core.management.base import BaseCommand, CommandError
+from books import compile_queries
+from books.run_queries import run, DEFAULT_SIZES, DEFAULT_DATABASES, DEFAULT_REPEAT
 
-from books.run_queries import run
+
+def int_list(s):
+    return [int(i) for i in s.split(",") if i]
 
 
 class Command(BaseCommand):
-    help = "run tests"
+    help = "Run the benchmark suite comparing djaq queries with QuerySets"
 
     def add_arguments(self, parser):
 
         parser.add_argument(
-            "--funcname", default=None, action="store", dest="funcname", type=str
+            "--funcname",
+            default=None,
+            action="store",
+            dest="funcname",
+            type=str,
+            help="Only run scenarios starting with this name",
         )
 
-        parser.add_argument("--v", action="store", dest="verbose", default=0, type=int)
+        parser.add_argument(
+            "--sizes",
+            default=DEFAULT_SIZES,
+            action="store",
+            dest="sizes",
+            type=int_list,
+            help="Comma-separated list of book counts",
+        )
+
+        parser.add_argument(
+            "--database",
+            default=None,
+            action="append",
+            dest="databases",
+            help=f"Database alias to run against; can be repeated (default: {DEFAULT_DATABASES})",
+        )
+
+        parser.add_argument(
+            "--repeat", default=DEFAULT_REPEAT, action="store", dest="repeat", type=int
+        )
 
-        parser.add_argument("--sql", default=False, action="store_true", dest="sql")
+        parser.add_argument(
+            "--output",
+            default=None,
+            action="store",
+            dest="output",
+            type=str,
+            help="Write JSON results to this file instead of stdout",
+        )
+
+        parser.add_argument(
+            "--compile-only",
+            default=False,
+            action="store_true",
+            dest="compile_only",
+            help="Only measure compiling queries to SQL; nothing is executed",
+        )
+
+        parser.add_argument(
+            "--compiles",
+            default=compile_queries.DEFAULT_COMPILES,
+            action="store",
+            dest="compiles",
+            type=int,
+            help="Number of compiles per query with --compile-only",
+        )
+
+        parser.add_argument("--v", action="store", dest="verbose", default=0, type=int)
 
     def handle(self, *args, **options):
 
-        run(options)
+        if options.get("compile_only"):
+            compile_queries.run(options)
+        else:
+            run(options)
@@ -79,11 +79,11 @@ class Book(models.Model):
 
 
 @receiver(post_save, sender=Book)
-def create_ISBN(sender, instance, created, **kwargs):
+def create_ISBN(sender, instance, created, using=None, **kwargs):
     try:
-        ISBN.objects.get(book=instance)
+        ISBN.objects.using(using).get(book=instance)
     except ISBN.DoesNotExist:
-        ISBN.objects.create(book=instance)
+        ISBN.objects.using(using).create(book=instance)
 
 
 class ISBN(models.Model):
@@ -103,3 +103,13 @@ class Store(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class Topic(models.Model):
+    name = models.CharField(max_length=100)
+    parent = models.ForeignKey(
+        "self", on_delete=models.CASCADE, null=True, blank=True, related_name="children"
+    )
+
+    def __str__(self):
+        return self.name
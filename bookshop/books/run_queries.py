@@ -1,321 +1,286 @@
-import time
-import importlib
-import traceback
-
-from django.db.models import (
-    Q,
-    Avg,
-    Count,
-    Min,
-    Max,
-    Sum,
-    FloatField,
-    Subquery,
-    OuterRef,
-)
-from djaq.query import DjangoQuery as DQ
-from books.models import Author, Publisher, Book, Store
-
-
-def timeit(method):
-    """Decorator to print timing of function call."""
-
-    def timed(*args, **kw):
-        ts = time.time()
-        result = method(*args, **kw)
-        te = time.time()
-        if "log_time" in kw:
-            name = kw.get("log_name", method.__name__.upper())
-            kw["log_time"][name] = int((te - ts) * 1000)
-        else:
-            print("===========> %s  %2.2f ms" % (method.__name__, (te - ts) * 1000))
-        return result
+"""Benchmark suite comparing Djaq queries to their QuerySet equivalents.
 
-    return timed
+Each scenario has a Djaq implementation and an ORM implementation that
+produce the same result. Scenarios run against each database alias at
+each data size and the timings are emitted as JSON so that results can
+be compared across commits:
 
+    ./manage.py run --sizes 10000,100000 --database bench --output bench.json
 
-def sql(queryset):
-    """Get sql source for a queryset."""
-    sql, sql_params = queryset.query.get_compiler(using=queryset.db).as_sql()
-    return sql
+"""
 
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import traceback
+from datetime import datetime, timezone
+from decimal import Decimal
 
-@timeit
-def q_avg_price(**kwargs):
-    dq = DQ("(avg(b.price)) Book b")
-    a = []
-    for rec in dq.tuples():
-        a.append(rec)
-
-
-@timeit
-def q_avg_price_queryset(**kwargs):
-
-    a = []
-    qs = Book.objects.all().aggregate(Avg("price"))
+import django
+from django.core.management import call_command
+from django.db import connections
+from django.db.models import Q, Avg, Count, Min, Max
 
-    for rec in qs:
-        a.append(rec)
+from djaq import DjaqQuery as DQ
+from books.models import Author, Publisher, Book, Store
+from books.data_factory import bulk_build_data
 
+DEFAULT_SIZES = [10000, 100000, 1000000]
+DEFAULT_DATABASES = ["bench"]
+DEFAULT_REPEAT = 5
 
-@timeit
-def q_all_books(**kwargs):
-    dq = DQ("(b.id, b.name) Book b")
-    a = []
-    for rec in dq.tuples():
-        a.append(rec)
 
+def djaq_aggregates(using):
+    return list(DQ("Book", "avg(price), max(price), min(price)", using=using).tuples())
 
-@timeit
-def q_all_books_queryset(**kwargs):
 
-    a = []
-    qs = Book.objects.all()
-    #  print(sql(qs))
-    for rec in qs:
-        a.append(rec)
+def orm_aggregates(using):
+    return Book.objects.using(using).aggregate(Avg("price"), Max("price"), Min("price"))
 
 
-@timeit
-def q_diff_avg_price(**kwargs):
-    a = []
-    dq = DQ(
-        """
-    (Publisher.name, max(Book.price) -
-    avg(Book.price) as price_diff) Book b
-    """
+def djaq_group_by(using):
+    return list(
+        DQ(
+            "Book",
+            "publisher.name, count(id) as num_books, avg(price) as avg_price",
+            using=using,
+        ).tuples()
     )
-    for rec in dq.tuples():
-        a.append(rec)
 
 
-@timeit
-def q_diff_avg_price_queryset(**kwargs):
-
-    a = []
-    qs = Book.objects.aggregate(
-        price_diff=Max("price", output_field=FloatField())
-        - Avg("price", output_field=FloatField())
+def orm_group_by(using):
+    return list(
+        Book.objects.using(using)
+        .values("publisher__name")
+        .annotate(num_books=Count("id"), avg_price=Avg("price"))
     )
-    for rec in qs:
-        a.append(rec)
-
-
-@timeit
-def q_books_per_publisher(**kwargs):
-
-    a = []
-    dq = DQ("(Publisher.name, count(Book.id) as num_books) Book b")
-    for rec in dq.tuples():
-        a.append(rec)
-
-
-@timeit
-def q_books_per_publisher_queryset(**kwargs):
 
-    a = []
-    qs = Publisher.objects.annotate(num_books=Count("book"))
-    for rec in qs:
-        a.append(rec)
-
-
-@timeit
-def q_books_avg_min_max(**kwargs):
-
-    a = []
-    dq = DQ("(avg(b.price), max(b.price), min(b.price)) Book b")
-    for rec in dq.tuples():
-        a.append(rec)
-
-
-@timeit
-def q_books_avg_min_max_queryset(**kwargs):
-
-    a = []
-    qs = Book.objects.aggregate(Avg("price"), Max("price"), Min("price"))
-    for rec in qs:
-        a.append(rec)
 
+def djaq_subquery(using):
+    publishers = DQ("Publisher", "id", using=using).where("ilike(name, 'a%')")
+    return list(
+        DQ(
+            "Book",
+            "name, price",
+            names={"bench_publishers": publishers.parser},
+            using=using,
+        )
+        .where("publisher in '@bench_publishers'")
+        .tuples()
+    )
 
-@timeit
-def q_sub_query(**kwargs):
 
-    dq_sub = DQ("(b.id) Book{name == 'B*'} b", name="dq_sub")  # noqa: F841
-    list(DQ("(b.name, b.price) Book{id in '@dq_sub'} b").tuples())
+def orm_subquery(using):
+    publishers = Publisher.objects.using(using).filter(name__istartswith="a")
+    return list(
+        Book.objects.using(using)
+        .filter(publisher__in=publishers.values("id"))
+        .values_list("name", "price")
+    )
 
 
-@timeit
-def q_sub_queryset(**kwargs):
+def djaq_m2m(using):
+    return list(DQ("Book", "name, authors.name", using=using).tuples())
 
-    qs = Book.objects.filter(name__startswith="B").only("id")
-    dq = DQ("(b.name, b.price) Book{id in '@qs_sub'} b", names={"qs_sub": qs})
-    a = []
-    for rec in dq.tuples():
-        a.append(rec)
 
+def orm_m2m(using):
+    return list(Book.objects.using(using).values_list("name", "authors__name"))
 
-@timeit
-def q_sub_list(**kwargs):
 
-    qs = Book.objects.filter(name__startswith="B").only("id")
-    ids = [rec.id for rec in qs]
-    dq = DQ(
-        "(b.name, b.price) Book{id in '@qs_sub'} b",
-        names={"qs_sub": ids},
-        verbosity=kwargs.get("verbose"),
+def djaq_ilike(using):
+    return list(
+        DQ("Book", "id, name", using=using).where("ilike(name, '%the%')").tuples()
     )
 
-    a = []
-    for rec in dq.tuples():
-        a.append(rec)
-
 
-@timeit
-def q_params(**kwargs):
-
-    DQ(
-        """(b.id, b.name) Book{b.id == 1 or
-    regex(b.name, '$(mynamepattern)')} b """,
-        verbosity=kwargs["verbose"],
+def orm_ilike(using):
+    return list(
+        Book.objects.using(using)
+        .filter(name__icontains="the")
+        .values_list("id", "name")
     )
-    # print(str(dq.context({'mynamepattern':'I.*'})))
-
-    # dq = DQ("""(b.id, b.name) Book{b.id == '$(myid)' or
-    # regex(b.name, '$(mynamepattern)')} b """,
-    # verbosity=kwargs['verbose'])
 
-    # a = []
-    # for rec in dq.context({'myid': 1, 'mynamepattern':'I%'}).tuples():
-    #     a.append(rec)
 
+def djaq_conditional_sum(using):
+    return list(
+        DQ(
+            "Book",
+            """publisher.name,
+            sumif(rating < 3, 1, 0) as below_3,
+            sumif(rating >= 3, 1, 0) as above_3
+            """,
+            using=using,
+        ).tuples()
+    )
 
-@timeit
-def q_grouping(**kwargs):
 
-    dq = DQ(
-        "(b.id, b.name) Book{(b.id == 1 or b.id == 2) and b.id == 3} b ",
-        verbosity=kwargs["verbose"],
+def orm_conditional_sum(using):
+    below_3 = Count("id", filter=Q(rating__lt=3))
+    above_3 = Count("id", filter=Q(rating__gte=3))
+    return list(
+        Book.objects.using(using)
+        .values("publisher__name")
+        .annotate(below_3=below_3, above_3=above_3)
     )
 
-    qs = Book.objects.filter(name__startswith="B").only("id")
-    [rec.id for rec in qs][:3]
-    a = []
-    for rec in dq.limit(10).tuples():
-        a.append(rec)
 
+def djaq_count(using):
+    return DQ("Book", using=using).where("rating >= 3").count()
 
-@timeit
-def q_implicit_model(**kwargs):
-    list(DQ("(Book.name, Book.id)").tuples())
 
+def orm_count(using):
+    return Book.objects.using(using).filter(rating__gte=3).count()
 
-@timeit
-def q_ilike(**kwargs):
-    name_pattern = "C%"  # noqa: F841
-    list(DQ("(b.name) Book{ilike(b.name, '$(name_pattern)')} b ").tuples())
-    #  print(str(dq.context({"name_pattern": "C%"})))
 
-    #
-    #  print(str(dq.rewind().context(locals())))
+SCENARIOS = {
+    "aggregates": (djaq_aggregates, orm_aggregates),
+    "group_by": (djaq_group_by, orm_group_by),
+    "subquery": (djaq_subquery, orm_subquery),
+    "m2m": (djaq_m2m, orm_m2m),
+    "ilike": (djaq_ilike, orm_ilike),
+    "conditional_sum": (djaq_conditional_sum, orm_conditional_sum),
+    "count": (djaq_count, orm_count),
+}
 
 
-@timeit
-def q_rewind(**kwargs):
-    dq = DQ("(b.name) Book b")
-    a = []
-    for rec in dq.tuples():
-        a.append(rec)
-    a = []
-    for rec in dq.rewind().tuples():
-        a.append(rec)
+def git_commit():
+    """Return the current commit hash or None if not in a git checkout."""
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
 
 
-@timeit
-def q_rewind_queryset(**kwargs):
-    qs = Book.objects.all()
-    a = []
-    for rec in qs:
-        a.append(rec)
-    a = []
-    for rec in qs:
-        a.append(rec)
+def prepare_data(size, using):
+    """Make sure the database has at least size books.
 
+    Return the actual number of books. Run sizes in ascending order
+    on a fresh database to measure at exactly the requested sizes.
 
-@timeit
-def q_conditional_sum(**kwargs):
-    list(
-        DQ(
-            """
-    (sum(iif(b.rating >= 3, b.rating, 0)) as below_3, sum(iif(b.rating > 3, b.rating, 0)) as above_3) Book b
-        """
-        ).tuples()
-    )
-
+    """
+    call_command("migrate", database=using, verbosity=0)
+    if Book.objects.using(using).count() < size:
+        bulk_build_data(book_count=size, using=using, seed=size)
+    return Book.objects.using(using).count()
 
-@timeit
-def q_subquery(**kwargs):
 
-    pubs = DQ("(p.id) Publisher p", name="pubs")  # noqa: F841
-    books = DQ("(b.name) Book{publisher in '@pubs'} b")
-    if kwargs.get("sql"):
-        print(books.query())
-    a = []
-    for rec in books.tuples():
-        a.append(rec)
+def result_rows(result):
+    """Return result as a sorted list of tuples to compare implementations."""
+    if isinstance(result, dict):
+        result = [result]
+    if not isinstance(result, list):
+        return result
+    rows = [
+        tuple(
+            round(float(value), 6) if isinstance(value, (Decimal, float)) else value
+            for value in (row.values() if isinstance(row, dict) else row)
+        )
+        for row in result
+    ]
+    return sorted(rows, key=repr)
 
 
-@timeit
-def q_subquery_outerref(**kwargs):
-    qs = Book.objects.filter(
-        publisher__in=Subquery(
-            Publisher.objects.filter(pk=OuterRef("publisher")).only("pk")
-        )
-    )
-    if kwargs.get("sql"):
-        print(sql(qs))
-    a = []
-    for rec in qs:
-        a.append(rec)
+def check_results(name, using):
+    """Raise if the implementations of a scenario have different results."""
+    djaq_func, orm_func = SCENARIOS[name]
+    if result_rows(djaq_func(using)) != result_rows(orm_func(using)):
+        raise Exception(f"Results of djaq and the ORM differ for {name}")
 
 
-@timeit
-def q_count(**kwargs):
-    #  print(DQ("(Book.id)").count())
-    DQ("(count(Book.id)) Book").value()
+def time_call(func, using, repeat):
+    """Return a dict with timings in milliseconds for repeat calls of func."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(using)
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        "times_ms": times,
+        "min_ms": min(times),
+        "median_ms": statistics.median(times),
+        "mean_ms": statistics.mean(times),
+    }
 
 
-@timeit
-def q_count_queryset(**kwargs):
-    Book.objects.all().count()
+def run_scenario(name, size, using, repeat, verbose=0):
+    """Return a list of result dicts, one for djaq and one for the ORM.
 
+    The results of the implementations are compared once before timing.
+    If they differ, the scenario is not timed.
 
-@timeit
-def q_conditional_sum_queryset(**kwargs):
-    above_3 = Count("book", filter=Q(book__rating__gt=3))
-    below_3 = Count("book", filter=Q(book__rating__lte=3))
-    qs = Publisher.objects.annotate(below_3=below_3).annotate(above_3=above_3)
-    a = []
-    for rec in qs:
-        a.append(rec)
+    """
+    results = []
+    try:
+        check_results(name, using)
+        check_error = None
+    except Exception as e:
+        check_error = str(e)
+        if verbose:
+            traceback.print_exc()
+    for implementation, func in zip(["djaq", "orm"], SCENARIOS[name]):
+        result = {
+            "scenario": name,
+            "implementation": implementation,
+            "database": using,
+            "vendor": connections[using].vendor,
+            "rows": size,
+        }
+        if check_error:
+            result["error"] = check_error
+            results.append(result)
+            continue
+        try:
+            result.update(time_call(func, using, repeat))
+        except Exception as e:
+            # a scenario might not be supported by a vendor
+            result["error"] = str(e)
+            if verbose:
+                traceback.print_exc()
+        results.append(result)
+        if verbose:
+            print(json.dumps(result), file=sys.stderr)
+    return results
 
 
 def run(options):
-    """Run all functions in this module starting with 'q_'."""
-
-    m = importlib.import_module(__name__)
+    """Run the scenarios for all sizes and databases and emit JSON."""
 
+    sizes = options.get("sizes") or DEFAULT_SIZES
+    databases = options.get("databases") or DEFAULT_DATABASES
+    repeat = options.get("repeat") or DEFAULT_REPEAT
     pattern = options.get("funcname")
-
-    for funcname in [f for f in dir(m) if f.startswith("q_")]:
-        try:
-
-            if pattern:
-                if funcname.startswith(pattern):
-                    #  print("----------------------- {}".format(funcname))
-                    getattr(m, funcname)(**options)
-            else:
-                #  print("----------------------- {}".format(funcname))
-                getattr(m, funcname)(**options)
-        except Exception as e:
-            print(e)
-            traceback.print_exc()
+    verbose = options.get("verbose") or 0
+
+    names = [name for name in SCENARIOS if not pattern or name.startswith(pattern)]
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "repeat": repeat,
+        "results": [],
+    }
+    for using in databases:
+        for size in sorted(sizes):
+            rows = prepare_data(size, using)
+            for name in names:
+                report["results"].extend(
+                    run_scenario(name, rows, using, repeat, verbose=verbose)
+                )
+
+    output = options.get("output")
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return report
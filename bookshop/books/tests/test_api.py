@@ -7,6 +7,7 @@ import unittest
 from django.test import TestCase
 from django.test import RequestFactory
 from django.test import Client
+from django.test import override_settings
 from django.db.models import Q, Avg, Count, Min, Max, Sum, FloatField, F
 from django.db import connections
 from django.contrib.auth.models import User
@@ -28,7 +29,11 @@ from djaq.app_utils import (
     get_schema,
     get_model_classes,
 )
-from djaq.exceptions import ModelNotFoundException, UnknownFunctionException
+from djaq.exceptions import (
+    ModelNotFoundException,
+    UnknownFunctionException,
+    QueryBudgetExceededException,
+)
 
 from books.models import Author, Publisher, Book, Store, Profile
 
@@ -240,3 +245,39 @@ class TestDjaqAPI(TestCase):
         pk = result.get("creates")[0]
         a = Author.objects.get(name="joseph conrad")
         self.assertEquals(pk, a.id)
+
+    @override_settings(DJAQ_QUERY_BUDGET={"default": {"rows": 1, "action": "reject"}})
+    def test_query_budget_reject(self):
+        data = {"queries": [{"model": "Book", "output": "id, name"}]}
+        with self.assertRaises(QueryBudgetExceededException):
+            queries(data, user=self.user)
+
+        request_factory = RequestFactory()
+        request = request_factory.post(
+            REQUEST_ENDPOINT,
+            data=json.dumps(data),
+            content_type="application/json",
+        )
+        request.user = self.user
+        response = djaq_request_view(request)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("estimated rows", response.content.decode())
+
+    @override_settings(DJAQ_QUERY_BUDGET={"default": {"rows": 1, "action": "limit"}})
+    def test_query_budget_limit(self):
+        data = {"queries": [{"model": "Book", "output": "id, name"}]}
+        results = queries(data, user=self.user)
+        self.assertEqual(len(results[0]), 1)
+
+    @override_settings(
+        DJAQ_QUERY_BUDGET={
+            "default": {"cost": 0.001},
+            "users": {USERNAME: None},
+        }
+    )
+    def test_query_budget_user(self):
+        data = {"queries": [{"model": "Book", "output": "id, name"}]}
+        with self.assertRaises(QueryBudgetExceededException):
+            queries(data)
+        results = queries(data, user=self.user)
+        self.assertEqual(len(results[0]), BOOK_COUNT)
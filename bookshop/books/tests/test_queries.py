@@ -1,14 +1,16 @@
 import random
 import dataclasses
+import time
 import json
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import date, datetime
 import random
 from decimal import Decimal
 from traceback import print_tb
 import unittest
 
-from django.test import TestCase
+from django.db import connections
+from django.test import TestCase, override_settings
 
 from django.contrib.auth.models import User
 
@@ -16,12 +18,16 @@ import factory
 from faker import Faker
 
 from djaq import DjaqQuery as DQ
+from djaq.query import ExpressionParser
+from djaq.search import search_index_ddl
+from djaq.exceptions import QueryTimeoutException
 from django.db.models import Count, Q
-from django.db.models import DecimalField, Avg, Max
+from django.db.models import DecimalField, Avg, Max, Min, Sum
+from django.db.models.functions import TruncMonth
 from books.models import GENRE_CHOICES
 
 
-from books.models import Author, Publisher, Book, Store, Profile, Consortium
+from books.models import Author, Publisher, Book, Store, Profile, Consortium, Topic
 
 
 fake = Faker()
@@ -296,6 +302,41 @@ class TestDjaqQuery(TestCase):
 
         self.assertEqual(len(r), 3)
 
+    def test_in_list_bound(self):
+        ids = list(DQ(Book, "id").tuples(flat=True))
+        dq = DQ(Book, "id").where("id in {ids}")
+        assert "IN (" not in dq.sql()
+        assert len(list(dq.context({"ids": ids[:3]}).tuples())) == 3
+        assert len(list(dq.context({"ids": []}).tuples())) == 0
+        dq = DQ(Book, "id").where("id not in {ids}").context({"ids": ids[:3]})
+        assert dq.count() == BOOK_COUNT - 3
+        ExpressionParser.directory["in_ids"] = ids[:4]
+        assert DQ(Book, "id").where("id in '@in_ids'").count() == 4
+        # strings like those of a JSON request are converted for the column
+        strings = [str(i) for i in ids[:3]]
+        dq = DQ(Book, "id").where("id in {ids}").context({"ids": strings})
+        assert sorted(dq.tuples(flat=True)) == sorted(ids[:3])
+
+    @override_settings(DJAQ_IN_LIST_TABLE_THRESHOLD=2)
+    def test_in_list_temp_table(self):
+        ids = list(DQ(Book, "id").tuples(flat=True))
+        dq = DQ(Book, "id").where("id in {ids}").context({"ids": ids[:5]})
+        assert dq.count() == 5
+        assert len(list(dq.tuples())) == 5
+        dq = DQ(Book, "id").where("id not in {ids}").context({"ids": ids[:5]})
+        assert dq.count() == BOOK_COUNT - 5
+        dq = DQ(Book, "id").where("id in {ids}")
+        assert dq.context({"ids": [str(i) for i in ids[:5]]}).count() == 5
+
+        # queries iterated at the same time have their own tables
+        first = DQ(Book, "id").where("id in {ids}").context({"ids": ids[:5]})
+        second = DQ(Book, "id").where("id in {ids}").context({"ids": ids[5:8]})
+        first_rows, second_rows = first.tuples(flat=True), second.tuples(flat=True)
+        next(first_rows)
+        assert len(list(second_rows)) == 3
+        assert len(list(first_rows)) == 4
+        assert not first.parser.temp_tables and not second.parser.temp_tables
+
     # concatenate where clauses
 
     # test validators
@@ -312,6 +353,48 @@ class TestDjaqQuery(TestCase):
         DQ("Book", "id", name="dq_sub").where("ilike(name, {spec})")
         DQ("Book", "name, price").where("id in '@dq_sub'").context({"spec": "B%"}).go()
 
+    def test_queryset_composition(self):
+        publishers = Publisher.objects.filter(name__startswith="Alt").values("id")
+        dq = DQ("Book", "id", names={"alt_publishers": publishers})
+        dq = dq.where("publisher in '@alt_publishers'")
+        assert "Alt" not in dq.sql()
+        assert set(dq.tuples(flat=True)) == set(
+            Book.objects.filter(publisher__name__startswith="Alt").values_list(
+                "id", flat=True
+            )
+        )
+
+        sub = DQ("Book", "id").where("price > {price} and id in {ids}")
+        sub = sub.context({"price": 10, "ids": list(dq.tuples(flat=True))})
+        dq = DQ("Book", "count(id)", names={"dq_price": sub.parser})
+        dq = dq.where("id in '@dq_price'").context({"price": 1000})
+        expected = Book.objects.filter(price__gt=10, publisher__name__startswith="Alt")
+        assert dq.value() == expected.count()
+
+        qs = Book.objects.filter(id__in=sub)
+        assert set(qs.values_list("id", flat=True)) == set(
+            expected.values_list("id", flat=True)
+        )
+
+        # compiled for the database of the QuerySet, without a temp table
+        with override_settings(DJAQ_IN_LIST_TABLE_THRESHOLD=2):
+            sql, params = sub.as_sql(None, connections["bench"])
+            assert "json_each" in sql and "djaq_" not in sql
+            sql, params = sub.as_sql(None, connections["default"])
+            assert "ANY" in sql and "djaq_" not in sql
+            assert Book.objects.filter(id__in=sub).count() == expected.count()
+
+    def test_shared_subquery_cte(self):
+        names = {"dq_cte": DQ("Book", "id").where("pages > 0").parser}
+        dq = DQ("Book", "id", names=names)
+        assert not dq.where("id in '@dq_cte'").sql().startswith("WITH")
+        dq = dq.where("id in '@dq_cte' and not id not in '@dq_cte'")
+        sql = dq.sql()
+        assert sql.startswith("WITH")
+        assert sql.count("_djaq_") == 1
+        assert dq.count() == BOOK_COUNT
+        assert dq.materialize().count() == BOOK_COUNT
+
     def test_queryset_vs_djaq(self):
         """ "Get exactly equivalent queries and compare.
         There should be no difference."""
@@ -376,6 +459,382 @@ class TestDjaqQuery(TestCase):
     def test_len(self):
         assert len(DQ("Book")) == 10
 
+    def test_timeout(self):
+        dq = DQ("Book", "id, generate_series(1, 10000000)").timeout(0.05)
+        with self.assertRaises(QueryTimeoutException):
+            list(dq.tuples())
+        # the connection is still usable and the timeout did not leak
+        assert len(list(DQ("Book").timeout(10).dicts())) == BOOK_COUNT
+        assert len(list(DQ("Book", "id, generate_series(1, 2)").tuples())) == 20
+
+    def test_close_on_partial_iteration(self):
+        dq = DQ("Book", "id")
+        for _ in dq.tuples():
+            break
+        assert dq.parser.cursor is None
+
+    def test_literals_are_parameters(self):
+        dq1 = DQ("Book", "id, price * 2").where("pages > 10 and name == 'x'")
+        dq2 = DQ("Book", "id, price * 3").where("pages > 20 and name == 'y'")
+        assert dq1.sql() == dq2.sql()
+        assert "'x'" not in dq1.sql()
+        assert dq1.limit(5).sql() == dq2.limit(6).sql()
+        assert DQ("Book").where("pages > 0 and name != ''").count() == BOOK_COUNT
+        assert len(list(DQ("Book").limit(3).offset(2).tuples())) == 3
+
+    def test_subquery_literals(self):
+        DQ("Book", "id", name="dq_literals").where("pages > 0 and name != 'x'")
+        dq = DQ("Book", "id").where("id in '@dq_literals' and price > -1")
+        assert dq.count() == BOOK_COUNT
+
+    def test_join_pruning(self):
+        dq = DQ("Book", "name, publisher.id")
+        assert "JOIN" not in dq.sql()
+        assert sorted(dq.tuples()) == sorted(
+            Book.objects.values_list("name", "publisher_id")
+        )
+        dq = DQ("Book", "name, authors.id")
+        assert dq.sql().count("JOIN") == 1
+        assert sorted(dq.tuples(), key=str) == sorted(
+            Book.objects.values_list("name", "authors__id"), key=str
+        )
+        assert "books_consortium" not in DQ("Book", "publisher.owner.id").sql()
+        assert DQ("Book", "publisher.name").sql().count("JOIN") == 1
+
+    def test_inner_join_inference(self):
+        # non-null foreign key
+        assert "INNER JOIN books_publisher" in DQ("Book", "publisher.name").sql()
+        # nullable foreign key
+        assert "LEFT JOIN" in DQ("Book", "alt_publisher.name").sql()
+        dq = DQ("Book", "id, authors.name").where("authors.age > 30")
+        assert "LEFT JOIN" not in dq.sql()
+        assert dq.count() == Book.objects.filter(authors__age__gt=30).count()
+        dq = DQ("Book", "id").where("authors.age > 30 or price > 0")
+        assert "INNER JOIN" not in dq.sql()
+        assert dq.count() == Book.objects.filter(
+            Q(authors__age__gt=30) | Q(price__gt=0)
+        ).count()
+
+    def test_semi_join(self):
+        book = Book.objects.first()
+        book.authors.add(*Author.objects.exclude(book=book)[:2])
+        dq = DQ("Book", "id").where("authors.age > 0 and pages > 0")
+        assert "EXISTS" in dq.sql()
+        assert sorted(dq.tuples(flat=True)) == sorted(
+            Book.objects.filter(authors__age__gt=0, pages__gt=0)
+            .distinct()
+            .values_list("id", flat=True)
+        )
+        # a path used outside of where still needs the join
+        dq = DQ("Book", "id, authors.name").where("authors.age > 0")
+        assert "EXISTS" not in dq.sql()
+        assert dq.count() == Book.objects.filter(authors__age__gt=0).count()
+        dq = DQ("Publisher", "id").where("ilike(book.name, '%')")
+        assert "EXISTS" in dq.sql()
+        publishers = Publisher.objects.filter(book__isnull=False).distinct()
+        assert dq.count() == publishers.count()
+        # a path back to our own table is joined, not correlated by table name
+        name = book.publisher.name
+        dq = DQ("Publisher", "id").where(f"book.publisher.name == '{name}'")
+        assert "EXISTS" not in dq.sql()
+        assert set(dq.tuples(flat=True)) == set(
+            Publisher.objects.filter(book__publisher__name=name).values_list(
+                "id", flat=True
+            )
+        )
+
+    def test_pre_aggregation(self):
+        dq = DQ("Publisher", "id, count(book.id), sum(book.pages), avg(book.price)")
+        assert "djaq_agg_book" in dq.sql()
+        expected = Publisher.objects.annotate(
+            Count("book__id"), Sum("book__pages"), Avg("book__price")
+        ).values_list("id", "book__id__count", "book__pages__sum", "book__price__avg")
+        assert sorted(dq.tuples()) == sorted(expected)
+        # two to-many relations do not multiply each other
+        dq = DQ("Book", "id, count(authors.id), count(store.id)")
+        expected = Book.objects.annotate(
+            Count("authors", distinct=True), Count("store", distinct=True)
+        ).values_list("id", "authors__count", "store__count")
+        assert sorted(dq.tuples()) == sorted(expected)
+
+    def test_sargable_dates(self):
+        pubdate = Book.objects.first().pubdate
+        dq = DQ("Book", "id").where(f"pubdate.year == {pubdate.year}")
+        assert "date_part" not in dq.sql()
+        assert sorted(dq.tuples()) == sorted(
+            Book.objects.filter(pubdate__year=pubdate.year).values_list("id")
+        )
+        dq = DQ("Book", "id").where(
+            f"pubdate.year == {pubdate.year} and pubdate.month == {pubdate.month}"
+        )
+        assert "date_part" not in dq.sql()
+        assert dq.count() == (
+            Book.objects.filter(
+                pubdate__year=pubdate.year, pubdate__month=pubdate.month
+            ).count()
+        )
+        dq = DQ("Book", "id").where(f"pubdate.year <= {pubdate.year}")
+        expected = Book.objects.filter(pubdate__year__lte=pubdate.year)
+        assert dq.count() == expected.count()
+        # a month of any year is not a range
+        dq = DQ("Book", "id").where(f"pubdate.month == {pubdate.month}")
+        assert "date_part" in dq.sql()
+
+    def test_string_patterns(self):
+        name = Book.objects.first().name
+        prefix = name[:3]
+        dq = DQ("Book", "id").where(f"ilike(name, '{prefix.upper()}%')")
+        assert "ILIKE" not in dq.sql()
+        assert dq.count() == Book.objects.filter(name__istartswith=prefix).count()
+        dq = DQ("Book", "id").where(f"name == '{prefix}*'")
+        assert dq.count() == Book.objects.filter(name__startswith=prefix).count()
+        assert not dq.index_hints()
+        dq = DQ("Book", "id").where("ilike(name, '%E%')")
+        assert dq.count() == Book.objects.filter(name__icontains="e").count()
+        assert dq.index_hints() == [
+            {"field": "name", "pattern": "%E%", "index": "trigram"}
+        ]
+        # LIKE is case insensitive on SQLite, so is the range it becomes
+        dq = DQ("Book", "id").where("like(name, 'Ab1%')")
+        dq.parser.vendor = "sqlite"
+        sql = dq.sql()
+        assert "LIKE" not in sql and 'LOWER("books_book"."name") <' in sql
+        assert list(dq.parser.literals.values()) == ["ab1", "ab2"]
+
+    def test_search(self):
+        book = Book.objects.first()
+        book.name = "The dragons of autumn"
+        book.save()
+        dq = DQ("Book", "id, rank(name, 'dragon autumn')").where(
+            "search(name, 'dragon autumn')"
+        )
+        rows = list(dq.tuples())
+        assert [row[0] for row in rows] == [book.id]
+        assert rows[0][1] > 0
+        assert not DQ("Book", "id").where("search(name, 'dragon -autumn')").count()
+        # the index is on the expression we search
+        ddl = search_index_ddl(Book, "name", "postgresql")
+        assert "USING gin (to_tsvector('english', \"name\"))" in ddl[0]
+
+    def test_display_mapped_after_fetch(self):
+        dq = DQ("Book", "id, genre_display, publisher.name")
+        assert "CASE" not in dq.sql()
+        expected = {b.id: b.get_genre_display() for b in Book.objects.all()}
+        assert {row[0]: row[1] for row in dq.tuples()} == expected
+        # where still compares labels
+        dq = DQ("Book", "id").where("genre_display == 'Fantasy'")
+        assert dq.count() == Book.objects.filter(genre="F").count()
+
+    def test_distinct_on(self):
+        dq = DQ("Book", "publisher, pubdate").distinct_on("publisher")
+        dq = dq.order_by("publisher, -pubdate")
+        latest = Book.objects.values("publisher").annotate(Max("pubdate"))
+        assert list(dq.tuples()) == sorted(
+            (row["publisher"], row["pubdate__max"]) for row in latest
+        )
+
+    def test_top_per_group(self):
+        dq = DQ("Book", "genre, id").top_per_group("genre", "-price, id", 2)
+        expected = {}
+        for book in Book.objects.order_by("-price", "id"):
+            expected.setdefault(book.genre, [])
+            if len(expected[book.genre]) < 2:
+                expected[book.genre].append(book.id)
+        result = {}
+        for genre, id in dq.tuples():
+            result.setdefault(genre, []).append(id)
+        assert {k: sorted(v) for k, v in result.items()} == {
+            k: sorted(v) for k, v in expected.items()
+        }
+        assert dq.count() == sum(len(v) for v in expected.values())
+
+    def test_window_functions(self):
+        dq = DQ(
+            "Book",
+            """id, sum(price).over(partition=publisher, order=id) as running,
+            row_number().over(order=-price) as position""",
+        ).order_by("id")
+        running = {}
+        expected = []
+        for book in Book.objects.order_by("id"):
+            running[book.publisher_id] = running.get(book.publisher_id, 0) + book.price
+            expected.append((book.id, running[book.publisher_id]))
+        rows = list(dq.tuples())
+        assert [row[:2] for row in rows] == expected
+        assert sorted(row[2] for row in rows) == list(range(1, BOOK_COUNT + 1))
+        # no grouping by the window function of an aggregate
+        dq = DQ("Book", "publisher, count(id), rank().over(order=-count(id))")
+        publishers = Book.objects.distinct().values("publisher")
+        assert len(list(dq.tuples())) == publishers.count()
+        dq = DQ("Book", "id, avg(price).over(order=id, rows=(-1, 0))")
+        assert "ROWS BETWEEN 1 PRECEDING AND CURRENT ROW" in dq.sql()
+
+    def test_rollup(self):
+        dq = DQ("Book", "publisher, genre, count(id) as n").rollup("publisher, genre")
+        rows = list(dq.dicts())
+        assert rows[0].keys() == {
+            "publisher",
+            "genre",
+            "n",
+            "grouping_publisher",
+            "grouping_genre",
+        }
+        totals = [r for r in rows if r["grouping_publisher"]]
+        assert totals == [
+            {
+                "publisher": None,
+                "genre": None,
+                "n": BOOK_COUNT,
+                "grouping_publisher": 1,
+                "grouping_genre": 1,
+            }
+        ]
+        subtotals = {
+            r["publisher"]: r["n"]
+            for r in rows
+            if r["grouping_genre"] and not r["grouping_publisher"]
+        }
+        expected = Book.objects.values("publisher").annotate(n=Count("id"))
+        assert subtotals == {r["publisher"]: r["n"] for r in expected}
+        dq = DQ("Book", "genre, count(id)").grouping_sets(["genre", ""])
+        assert len(list(dq.tuples())) == (
+            Book.objects.values("genre").distinct().count() + 1
+        )
+
+    def test_bucket(self):
+        dq = DQ("Book", "bucket(pubdate, 'month'), count(id)")
+        expected = Book.objects.annotate(month=TruncMonth("pubdate")).values("month")
+        expected = expected.annotate(n=Count("id"))
+        assert {str(month): n for month, n in dq.tuples()} == {
+            str(r["month"]): r["n"] for r in expected
+        }
+
+        last = Book.objects.aggregate(Max("pubdate"))["pubdate__max"]
+        end = date(last.year + 2, 1, 1)
+        rows = list(
+            DQ("Book", "bucket(pubdate, 'year'), count(id)").fill_gaps(end=end).tuples()
+        )
+        assert sum(n for _, n in rows) == BOOK_COUNT
+        assert [str(year)[:4] for year, _ in rows[-2:]] == [
+            str(last.year + 1),
+            str(last.year + 2),
+        ]
+        assert [n for _, n in rows[-2:]] == [0, 0]
+        first = Book.objects.aggregate(Min("pubdate"))["pubdate__min"]
+        assert len(rows) == last.year + 2 - first.year + 1
+
+    def test_set_operations(self):
+        cheap = DQ("Book", "id").where("price < {price}").context({"price": 10})
+        dear = DQ("Book", "id").where("price > {price}").context({"price": 20})
+        union = cheap.union(dear).order_by("-id").limit(3)
+        expected = Book.objects.filter(Q(price__lt=10) | Q(price__gt=20))
+        expected = list(expected.order_by("-id").values_list("id", flat=True)[:3])
+        assert list(union.tuples(flat=True)) == expected
+        assert len(list(cheap.union(cheap, all=True).tuples())) == 2 * cheap.count()
+
+        ids = list(Book.objects.values_list("id", flat=True)[:4])
+        chosen = DQ("Book", "id").where("id in {ids}").context({"ids": ids})
+        assert set(dear.intersect(chosen).tuples(flat=True)) == set(
+            Book.objects.filter(price__gt=20, id__in=ids).values_list("id", flat=True)
+        )
+        assert set(chosen.difference(dear).tuples(flat=True)) == set(
+            Book.objects.filter(id__in=ids)
+            .exclude(price__gt=20)
+            .values_list("id", flat=True)
+        )
+        with self.assertRaises(Exception):
+            cheap.union(DQ("Book", "id, name")).sql()
+
+    def test_recursive(self):
+        science = Topic.objects.create(name="Science")
+        physics = Topic.objects.create(name="Physics", parent=science)
+        optics = Topic.objects.create(name="Optics", parent=physics)
+        Topic.objects.create(name="Biology", parent=science)
+        Topic.objects.create(name="Art")
+
+        dq = DQ("Topic", "name").recursive("parent", start="name == 'Science'")
+        rows = list(dq.dicts())
+        assert [r["name"] for r in rows] == ["Science", "Physics", "Optics", "Biology"]
+        assert {r["name"]: r["depth"] for r in rows} == {
+            "Science": 0,
+            "Physics": 1,
+            "Optics": 2,
+            "Biology": 1,
+        }
+        assert rows[2]["path"] == f"{science.id}/{physics.id}/{optics.id}"
+
+        dq = DQ("Topic", "name").recursive("parent", start=physics.id)
+        assert list(dq.tuples()) == [
+            ("Physics", 0, str(physics.id)),
+            ("Optics", 1, f"{physics.id}/{optics.id}"),
+        ]
+        dq = DQ("Topic", "name").recursive("parent", max_depth=1)
+        assert sorted(dq.tuples(flat=True)) == ["Art", "Biology", "Physics", "Science"]
+        # siblings by primary key, not by their text, and subtrees apart
+        children = [Topic.objects.create(name=f"{i}", parent=optics) for i in range(11)]
+        Topic.objects.create(name="lens", parent=children[0])
+        dq = DQ("Topic", "name").recursive("parent", start=optics.id)
+        assert list(dq.tuples(flat=True)) == ["Optics", "0", "lens"] + [
+            str(i) for i in range(1, 11)
+        ]
+        Topic.objects.filter(parent=optics).delete()
+        dq = DQ("Topic", "count(id)").recursive("parent", start=science.id)
+        assert list(dq.tuples()) == [(4,)]
+        dq = DQ("Topic", "count(id)").recursive("parent", max_depth=1)
+        assert "ORDER BY" not in dq.sql() and dq.value() == 4
+
+    def test_defer(self):
+        names = dict(Book.objects.values_list("id", "name"))
+        dq = DQ("Book").defer(["name"])
+        assert "name" not in dq.sql()
+        with self.assertNumQueries(2):
+            rows = list(dq.dicts())
+            assert "name" not in rows[0].keys()
+            assert {r["id"]: r["name"] for r in rows} == names
+        with self.assertNumQueries(2):
+            assert {b.id: b.name for b in dq.objs()} == names
+
+        dq = DQ("Book").only(["pages"])
+        assert list(dq.dicts())[0].keys() == {"id", "pages"}
+        dq = DQ("Book", "name, pages").defer(["name"])
+        row = next(dq.dicts())
+        assert row.keys() == {"id", "pages"}
+        assert "name" in row and row.get("name") == names[row["id"]]
+        assert "name" in next(dq.objs())
+        assert {r["id"]: r["name"] for r in map(json.loads, dq.json())} == names
+        assert all(line.count(",") == 2 for line in dq.csv())
+        assert list(DQ("Book", "name, pages").only(["pages"]).dicts())[0].keys() == {
+            "id",
+            "pages",
+        }
+        with self.assertRaises(Exception):
+            DQ("Book", "publisher.name, count(id)").defer(["name"])
+        with override_settings(DJAQ_DEFER_LARGE_FIELDS=["CharField"]):
+            dq = DQ("Book")
+            assert '"name"' not in dq.sql()
+            assert {r["id"]: r["name"] for r in dq.dicts()} == names
+
+    def test_first_exists_get_one(self):
+        dq = DQ("Book", "id, name").order_by("id")
+        book = Book.objects.order_by("id").first()
+        assert dq.first().name == book.name
+        assert dq.value() == book.id
+        assert dq.exists()
+        assert not dq.where("id < 0").exists()
+        assert dq.where("id < 0").first() is None
+        assert dq.where("id == {id}").context({"id": book.id}).get_one().id == book.id
+        with self.assertRaises(Book.DoesNotExist):
+            dq.where("id < 0").get_one()
+        with self.assertRaises(Book.MultipleObjectsReturned):
+            dq.get_one()
+        sql = dq.limited(1).sql()
+        assert "LIMIT" in sql and "LIMIT" not in dq.sql()
+
+    def test_group_by_expression(self):
+        dq = DQ("Book", "publisher.name, price * 2, count(id)")
+        assert dq.sql() == dq.sql()
+        assert sum(row[2] for row in dq.tuples()) == BOOK_COUNT
+
     #    order by won't work on aliased names
 
     # test for not null or is null or empty
@@ -385,3 +844,30 @@ class TestDjaqQuery(TestCase):
     # OneToOne rel fields
 
     # datetime to date
+
+
+class TestSqlite(TestCase):
+    databases = {"default", "bench"}
+
+    def test_timeout_while_suspended(self):
+        Topic.objects.using("bench").bulk_create(
+            Topic(name=f"topic {i}") for i in range(3000)
+        )
+        rows = DQ("Topic", "id, name", using="bench").timeout(0.2).tuples()
+        next(rows)
+        time.sleep(0.3)
+        # time between fetches does not count and other queries run
+        assert Topic.objects.using("bench").filter(name__contains="9").count() > 0
+        assert len(list(rows)) == 2999
+
+    @override_settings(DJAQ_IN_LIST_TABLE_THRESHOLD=2)
+    def test_temp_tables_while_suspended(self):
+        Topic.objects.using("bench").bulk_create(
+            Topic(name=f"topic {i}") for i in range(3000)
+        )
+        ids = list(Topic.objects.using("bench").values_list("id", flat=True))
+        dq = DQ("Topic", "id", using="bench").where("id in {ids}")
+        first = dq.context({"ids": ids[:2000]}).tuples()
+        next(first)
+        assert len(list(dq.context({"ids": ids[2000:]}).tuples())) == 1000
+        assert len(list(first)) == 1999
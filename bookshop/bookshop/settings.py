@@ -75,7 +75,12 @@ DATABASES = {
         "HOST": "localhost",
         "USER": "postgres",
         "PASSWORD": "postgres",
-    }
+    },
+    # local database file for the benchmark suite, see books/run_queries.py
+    "bench": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(BASE_DIR, "bench.sqlite3"),
+    },
 }
 
 
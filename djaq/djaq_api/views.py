@@ -9,6 +9,7 @@ from django.views.decorators.csrf import csrf_exempt
 from django.http import (
     HttpResponse,
     HttpResponseRedirect,
+    HttpResponseBadRequest,
     JsonResponse,
     HttpResponseServerError,
 )
@@ -17,6 +18,7 @@ from django.apps import apps
 
 from djaq import DjaqQuery as DQ
 from djaq import app_utils
+from djaq.exceptions import QueryBudgetExceededException, QueryTimeoutException
 
 import pdb
 
@@ -35,6 +37,12 @@ staff: true
 admin: true
 groups: []
 }
+DJAQ_QUERY_BUDGET = {
+default: {cost: 100000, rows: 10000, action: "limit"}
+groups: {analysts: {cost: 1000000, rows: 100000}}
+users: {admin: None}
+}
+DJAQ_QUERY_TIMEOUT = 30
 
 """
 
@@ -74,11 +82,95 @@ def get_whitelist():
     return list()
 
 
-def queries(request_data, whitelist=None, validator=None):
+def get_query_timeout():
+    """Return the statement timeout in seconds for API queries."""
+    if hasattr(settings, "DJAQ_QUERY_TIMEOUT"):
+        return settings.DJAQ_QUERY_TIMEOUT
+    return None
+
+
+def get_query_budget(user=None):
+    """Return the budget dict that applies to user or None for no budget.
+
+    A budget for the username wins over group budgets. If the user is in
+    more than one group with a budget, the most generous limits apply.
+
+    """
+    if not hasattr(settings, "DJAQ_QUERY_BUDGET"):
+        return None
+    budgets = settings.DJAQ_QUERY_BUDGET
+    default = budgets.get("default")
+    if user is None or not user.is_authenticated:
+        return default
+
+    users = budgets.get("users", dict())
+    if user.get_username() in users:
+        return users[user.get_username()]
+
+    groups = budgets.get("groups", dict())
+    group_budgets = [
+        groups[name]
+        for name in user.groups.values_list("name", flat=True)
+        if name in groups
+    ]
+    if not group_budgets:
+        return default
+    if None in group_budgets:
+        return None
+
+    budget = dict(group_budgets[0])
+    for group_budget in group_budgets[1:]:
+        for key in ["cost", "rows"]:
+            if not budget.get(key) or not group_budget.get(key):
+                budget[key] = None
+            else:
+                budget[key] = max(budget[key], group_budget[key])
+        if group_budget.get("action") == "limit":
+            budget["action"] = "limit"
+    return budget
+
+
+def apply_query_budget(dq, budget, model_name=None):
+    """Return dq if the planner estimates are within budget.
+
+    If the estimated rows are too many and the budget action is "limit",
+    return dq limited to the budgeted rows. Otherwise raise
+    QueryBudgetExceededException.
+
+    """
+    if not budget:
+        return dq
+    plan = dq.explain()
+    if plan is None:
+        # no planner estimates for this vendor
+        return dq
+
+    max_cost = budget.get("cost")
+    max_rows = budget.get("rows")
+    rows = plan["Plan Rows"]
+    if max_rows and rows > max_rows:
+        if not budget.get("action") == "limit":
+            raise QueryBudgetExceededException(
+                f"Query on {model_name} rejected: estimated rows {rows} exceed budget of {max_rows}"
+            )
+        dq = dq.limit(max_rows)
+        plan = dq.explain()
+
+    cost = plan["Total Cost"]
+    if max_cost and cost > max_cost:
+        raise QueryBudgetExceededException(
+            f"Query on {model_name} rejected: estimated cost {cost} exceeds budget of {max_cost}"
+        )
+    return dq
+
+
+def queries(request_data, whitelist=None, validator=None, user=None):
 
     query_list = request_data.get("queries")
     if not query_list:
         return list()
+    budget = get_query_budget(user)
+    timeout = get_query_timeout()
     responses = list()
     for data in query_list:
         model_name = data.get("model")
@@ -88,16 +180,16 @@ def queries(request_data, whitelist=None, validator=None):
         page = int(data.get("page", 0))
         page_size = int(data.get("page_size", 0))
 
-        responses.append(
-            list(
-                DQ(model_name, output, whitelist=whitelist)
-                .where(where)
-                .order_by(order_by)
-                .offset(page * page_size)
-                .limit(page_size)
-                .dicts()
-            )
+        dq = (
+            DQ(model_name, output, whitelist=whitelist)
+            .where(where)
+            .order_by(order_by)
+            .offset(page * page_size)
+            .limit(page_size)
+            .timeout(timeout)
         )
+        dq = apply_query_budget(dq, budget, model_name)
+        responses.append(list(dq.dicts(load_deferred=True)))
     return responses
 
 
@@ -173,7 +265,9 @@ def djaq_request_view(request):
     # ctx = get_context_data(data)
 
     try:
-        queries_result = queries(request_data, whitelist=whitelist, validator=validator)
+        queries_result = queries(
+            request_data, whitelist=whitelist, validator=validator, user=request.user
+        )
         creates_result = (
             creates(request_data.get("creates"), whitelist=whitelist)
             if has_permission("creates")
@@ -202,6 +296,12 @@ def djaq_request_view(request):
                 }
             }
         )
+    except QueryBudgetExceededException as e:
+        logger.warning(e)
+        return HttpResponseBadRequest(str(e))
+    except QueryTimeoutException as e:
+        logger.warning(e)
+        return HttpResponse(str(e), status=504)
     except Exception as e:
 
         print("-" * 60)
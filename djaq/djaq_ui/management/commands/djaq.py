@@ -115,7 +115,11 @@ class Command(BaseCommand):
             return
 
         if options.get("format") == "dicts":
-            print(json.dumps(list(q.dicts()), cls=DjangoJSONEncoder, indent=4))
+            print(
+                json.dumps(
+                    list(q.dicts(load_deferred=True)), cls=DjangoJSONEncoder, indent=4
+                )
+            )
         else:
             for rec in getattr(q, options.get("format"))():
                 print(rec)
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from djaq.app_utils import find_model_class
+from djaq.exceptions import ModelNotFoundException
+from djaq.search import create_search_index
+
+
+class Command(BaseCommand):
+    help = "Create the indexes used by the search() and rank() functions"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "model", type=str, help="The model name; can be fully qualified"
+        )
+        parser.add_argument(
+            "fields", nargs="+", type=str, help="The text fields to index"
+        )
+        parser.add_argument(
+            "--database",
+            default="default",
+            action="store",
+            dest="database",
+            type=str,
+            help="Database alias to create the indexes in",
+        )
+        parser.add_argument(
+            "--drop",
+            action="store_true",
+            default=False,
+            help="Drop the indexes instead",
+        )
+        parser.add_argument(
+            "--sql",
+            action="store_true",
+            default=False,
+            help="Print the statements that were executed",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            model = find_model_class(options.get("model"))
+        except ModelNotFoundException as e:
+            raise CommandError(str(e))
+        for field_name in options.get("fields"):
+            statements = create_search_index(
+                model,
+                field_name,
+                using=options.get("database"),
+                drop=options.get("drop"),
+            )
+            if options.get("sql"):
+                for sql in statements:
+                    print(sql)
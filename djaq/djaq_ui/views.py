@@ -81,7 +81,7 @@ def query_view(request):
                             .order_by(order_by)
                             .offset(offset)
                             .limit(limit)
-                            .dicts()
+                            .dicts(load_deferred=True)
                         )
                     }
                 except Exception as e:
@@ -4,3 +4,11 @@ class ModelNotFoundException(Exception):
 
 class UnknownFunctionException(Exception):
     pass
+
+
+class QueryBudgetExceededException(Exception):
+    pass
+
+
+class QueryTimeoutException(Exception):
+    pass
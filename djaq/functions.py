@@ -50,6 +50,7 @@ function_whitelist = [
     "AGE",
     "DATE_PART",
     "DATE_TRUNC",
+    "MAKE_DATE",
     "EXTRACT",
     "ISFINITE",
     "JUSTIFY_DAYS",
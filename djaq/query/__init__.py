@@ -8,8 +8,17 @@ import re
 import ast
 from ast import AST
 import functools
+import itertools
 import dataclasses
-from django.db import connections, models
+import logging
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, timedelta
+from django.conf import settings
+from django.db import connections, models, transaction
+from django.db.utils import OperationalError
 from django.db.models.query import QuerySet
 
 from django.utils.text import slugify
@@ -22,7 +31,7 @@ from django.db.models.fields.related import (
 )
 from django.core.exceptions import FieldDoesNotExist
 
-from djaq.result import DQResult
+from djaq.result import DQResult, DeferredChunk, DeferredRow
 
 from ..app_utils import (
     get_model_details,
@@ -36,14 +45,454 @@ from ..app_utils import (
     dataclass_mapper,
 )
 from ..functions import function_whitelist
-from djaq.exceptions import UnknownFunctionException
+from djaq.exceptions import UnknownFunctionException, QueryTimeoutException
 from djaq.conditions import B
+from djaq.search import postgresql_search, sqlite_search, like_search
 
 import pdb
 
+logger = logging.getLogger(__name__)
 
 PLACEHOLDER_PATTERN = re.compile(r"\{([\w]*)\}")
 
+# literals in the query source are bound as parameters with these names
+LITERAL_PREFIX = "_djaq_"
+
+# named parameters of the SQL like %(_djaq_0)s but not %%(name)s
+PARAMETER_PATTERN = re.compile(r"(?<!%)%\((\w+)\)s")
+
+# functions whose literal arguments are part of the SQL, like a type name
+INLINE_LITERAL_FUNCTIONS = {"CAST"}
+
+# references to named DjaqQuery, QuerySet or list objects like '@books'
+NAMED_SOURCE_PATTERN = re.compile(r"""['"]@(\w+)['"]""")
+
+# a column reference like "books_book"."name"
+COLUMN_PATTERN = re.compile(r'"(\w+)"\."\w+"')
+
+# comparisons that are never true for NULL operands
+NULL_REJECTING_OPERATORS = (ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In)
+
+# function calls that are never true for a NULL first argument
+NULL_REJECTING_FUNCTIONS = {"LIKE", "ILIKE", "REGEX", "SEARCH"}
+
+# functions that are only valid with OVER
+WINDOW_FUNCTIONS = {
+    "ROW_NUMBER",
+    "RANK",
+    "DENSE_RANK",
+    "PERCENT_RANK",
+    "CUME_DIST",
+    "NTILE",
+    "LAG",
+    "LEAD",
+    "FIRST_VALUE",
+    "LAST_VALUE",
+    "NTH_VALUE",
+}
+
+# a window function call like SUM(x) OVER (...)
+WINDOW_PATTERN = re.compile(r"\bOVER \(")
+
+# aggregates we can compute in a grouped subquery and combine again
+PRE_AGGREGATE_FUNCTIONS = {"count", "sum", "min", "max", "avg"}
+
+# attributes of date fields we can compare as a range of the column
+DATE_PARTS = {"year", "month", "day", "date"}
+
+# units of bucket(): SQLite expression, format and modifier of the next
+# bucket in the series of fill_gaps(), and the Postgresql interval
+BUCKET_UNITS = {
+    "year": ("strftime('%Y-01-01', {0})", "%Y-%m-%d", "+1 year", "1 year"),
+    "quarter": (
+        "strftime('%Y-', {0}) || printf('%02d', (strftime('%m', {0}) - 1) / 3 * 3 + 1)"
+        " || '-01'",
+        "%Y-%m-%d",
+        "+3 months",
+        "3 months",
+    ),
+    "month": ("strftime('%Y-%m-01', {0})", "%Y-%m-%d", "+1 month", "1 month"),
+    "week": (
+        "strftime('%Y-%m-%d', {0}, '-6 days', 'weekday 1')",
+        "%Y-%m-%d",
+        "+7 days",
+        "1 week",
+    ),
+    "day": ("strftime('%Y-%m-%d', {0})", "%Y-%m-%d", "+1 day", "1 day"),
+    "hour": (
+        "strftime('%Y-%m-%d %H:00:00', {0})",
+        "%Y-%m-%d %H:00:00",
+        "+1 hour",
+        "1 hour",
+    ),
+    "minute": (
+        "strftime('%Y-%m-%d %H:%M:00', {0})",
+        "%Y-%m-%d %H:%M:00",
+        "+1 minute",
+        "1 minute",
+    ),
+}
+
+# rows fetched at a time when labels of _display columns are mapped
+FETCH_BLOCK_SIZE = 1000
+
+# collections for IN with more values than this are loaded into a temp table
+IN_LIST_TABLE_THRESHOLD = 10000
+
+# fields deferred in "*" selects when DJAQ_DEFER_LARGE_FIELDS is True
+LARGE_FIELD_TYPES = {"TextField", "JSONField", "BinaryField"}
+
+# primary keys of these types are padded to a width in the order of recursive() rows
+INTEGER_FIELD_TYPES = {
+    "AutoField",
+    "BigAutoField",
+    "SmallAutoField",
+    "IntegerField",
+    "BigIntegerField",
+    "SmallIntegerField",
+    "PositiveIntegerField",
+    "PositiveBigIntegerField",
+    "PositiveSmallIntegerField",
+}
+TREE_KEY_WIDTH = 20
+
+
+def in_list_table_threshold():
+    """Return the collection size above which we use a temp table or None."""
+    return getattr(settings, "DJAQ_IN_LIST_TABLE_THRESHOLD", IN_LIST_TABLE_THRESHOLD)
+
+
+def large_field_types():
+    """Return the internal types of fields that "*" selects defer."""
+    types = getattr(settings, "DJAQ_DEFER_LARGE_FIELDS", False)
+    if types is True:
+        return LARGE_FIELD_TYPES
+    return set(types or [])
+
+
+def is_none(node):
+    """Return True if node is the literal None."""
+    # NameConstant before Python 3.8
+    return type(node).__name__ in ("Constant", "NameConstant") and node.value is None
+
+
+def constant_value(node):
+    """Return the value of a literal node or None."""
+    # Num and Str before Python 3.8
+    kind = type(node).__name__
+    if kind == "Constant":
+        return node.value
+    if kind == "Num":
+        return node.n
+    if kind == "Str":
+        return node.s
+    return None
+
+
+def date_range(path, op, lower, upper):
+    """Return a comparison of path with the half-open range [lower, upper).
+
+    It is equivalent to comparing a date part of path with op where
+    the part is equal exactly for values in the range.
+
+    """
+
+    def compare(op, bound):
+        return ast.Compare(
+            left=copy.deepcopy(path), ops=[op], comparators=[copy.deepcopy(bound)]
+        )
+
+    if isinstance(op, ast.Eq):
+        return ast.BoolOp(
+            op=ast.And(), values=[compare(ast.GtE(), lower), compare(ast.Lt(), upper)]
+        )
+    if isinstance(op, ast.NotEq):
+        return ast.BoolOp(
+            op=ast.Or(), values=[compare(ast.Lt(), lower), compare(ast.GtE(), upper)]
+        )
+    if isinstance(op, ast.Lt):
+        return compare(ast.Lt(), lower)
+    if isinstance(op, ast.LtE):
+        return compare(ast.Lt(), upper)
+    if isinstance(op, ast.Gt):
+        return compare(ast.GtE(), upper)
+    if isinstance(op, ast.GtE):
+        return compare(ast.GtE(), lower)
+    return None
+
+
+class SargableDates(ast.NodeTransformer):
+    """Replace comparisons of date parts like `pubdate.year == 2020` with ranges.
+
+    `date_part('year', pubdate) = 2020` cannot use an index on pubdate
+    but `pubdate >= '2020-01-01' AND pubdate < '2021-01-01'` can.
+
+    """
+
+    def __init__(self, parser):
+        self.parser = parser
+
+    def visit_BoolOp(self, node):
+        if isinstance(node.op, ast.And):
+            node.values = self.parser.merge_date_parts(node.values)
+        self.generic_visit(node)
+        if len(node.values) == 1:
+            return node.values[0]
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        return self.parser.date_range_compare(node) or node
+
+
+def like_prefix(pattern):
+    """Return the literal prefix if pattern is anchored like `abc%` or None."""
+    prefix = pattern[:-1]
+    if prefix and pattern.endswith("%") and not any(c in prefix for c in "%_\\"):
+        return prefix
+    return None
+
+
+def prefix_upper_bound(prefix):
+    """Return the smallest string greater than all strings starting with prefix."""
+    last = ord(prefix[-1])
+    if last >= 0x10FFFF:
+        return None
+    return prefix[:-1] + chr(last + 1)
+
+
+def ascii_lower(value):
+    """Return value with ASCII letters lowered, like lower() in SQLite."""
+    return "".join(c.lower() if c.isascii() else c for c in value)
+
+
+def path_name(node):
+    """Return a path like `publisher.name` as a string or None."""
+    names = []
+    while isinstance(node, ast.Attribute):
+        names.insert(0, node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    return ".".join([node.id] + names)
+
+
+def unwrap_lower(node):
+    """Return the argument of `lower(x)` or node."""
+    if (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Name)
+        and node.func.id.lower() == "lower"
+        and len(node.args) == 1
+    ):
+        return node.args[0]
+    return node
+
+
+class StringPatterns(ast.NodeTransformer):
+    """Rewrite string matching so that it can use indexes.
+
+    `name == 'B*'` is `like(name, 'B%')`. `ilike(name, 'B%')` is
+    `like(lower(name), 'b%')`, so that an index on lower(name) can be
+    used. On SQLite, where LIKE does not use indexes by default, an
+    anchored prefix is compared as a range. LIKE is case insensitive
+    for ASCII letters on SQLite, so a prefix with letters is compared
+    with lower(name) there. Patterns with a leading wildcard are
+    recorded as index hints.
+
+    """
+
+    def __init__(self, parser):
+        self.parser = parser
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1 and isinstance(node.ops[0], ast.Eq):
+            value = constant_value(node.comparators[0])
+            if isinstance(value, str) and "*" in value:
+                # `name == 'B*'` has always meant a LIKE pattern
+                return self.visit_Call(
+                    ast.Call(
+                        func=ast.Name(id="like", ctx=ast.Load()),
+                        args=[node.left, ast.Constant(value=value.replace("*", "%"))],
+                        keywords=[],
+                    )
+                )
+        return node
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if not (isinstance(node.func, ast.Name) and len(node.args) == 2):
+            return node
+        funcname = node.func.id.lower()
+        operand, pattern = node.args
+        value = constant_value(pattern)
+        if funcname not in ("like", "ilike", "regex") or not isinstance(value, str):
+            return node
+
+        if funcname == "regex":
+            if not value.startswith("^"):
+                self.parser.index_hint(operand, value, "trigram")
+            return node
+        if value.startswith(("%", "_")):
+            self.parser.index_hint(operand, value, "trigram")
+
+        if funcname == "ilike":
+            operand = ast.Call(
+                func=ast.Name(id="lower", ctx=ast.Load()), args=[operand], keywords=[]
+            )
+            value = value.lower()
+        prefix = like_prefix(value)
+        if (
+            prefix
+            and funcname == "like"
+            and self.parser.vendor == "sqlite"
+            and any(c.isascii() and c.isalpha() for c in prefix)
+        ):
+            # the range must match both cases like LIKE does
+            operand = ast.Call(
+                func=ast.Name(id="lower", ctx=ast.Load()), args=[operand], keywords=[]
+            )
+            prefix = ascii_lower(prefix)
+        upper = prefix and prefix_upper_bound(prefix)
+        if upper and self.parser.vendor == "sqlite":
+            return ast.BoolOp(
+                op=ast.And(),
+                values=[
+                    ast.Compare(
+                        left=operand,
+                        ops=[ast.GtE()],
+                        comparators=[ast.Constant(value=prefix)],
+                    ),
+                    ast.Compare(
+                        left=copy.deepcopy(operand),
+                        ops=[ast.Lt()],
+                        comparators=[ast.Constant(value=upper)],
+                    ),
+                ],
+            )
+        return ast.Call(
+            func=ast.Name(id="like", ctx=ast.Load()),
+            args=[operand, ast.Constant(value=value)],
+            keywords=[],
+        )
+
+
+class SemiJoin(ast.AST):
+    """Conditions on a to-many relation tested with EXISTS instead of a join.
+
+    field: the to-many field of the master model
+    root: the name of the field in the source
+    conditions: list of conditions with paths starting at root
+
+    """
+
+    _fields = ("conditions",)
+
+
+class PreAggregate(ast.AST):
+    """An aggregate over a to-many relation computed in a grouped subquery.
+
+    root: the name of the to-many field in the source
+    field: the to-many field of the master model
+    func: lower case name of the aggregate function
+    args: the arguments of the aggregate function
+
+    """
+
+    _fields = ("args",)
+
+
+class NodeReplacer(ast.NodeTransformer):
+    """Replace nodes by identity with the values of dict replacements."""
+
+    def __init__(self, replacements):
+        self.replacements = replacements
+
+    def visit(self, node):
+        if id(node) in self.replacements:
+            return self.replacements[id(node)]
+        return super().visit(node)
+
+
+class RootRenamer(ast.NodeTransformer):
+    """Make paths starting at root start at name instead.
+
+    If name is None, root is removed so that `book.price` becomes `price`.
+
+    """
+
+    def __init__(self, root, name):
+        self.root = root
+        self.name = name
+
+    def visit_Attribute(self, node):
+        if isinstance(node.value, ast.Name) and node.value.id == self.root:
+            if self.name:
+                node.value = ast.Name(id=self.name, ctx=ast.Load())
+                return node
+            return ast.Name(id=node.attr, ctx=ast.Load())
+        self.generic_visit(node)
+        return node
+
+
+def is_window_call(node):
+    """Return True if node is a window function like `sum(price).over()`."""
+    return (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Attribute)
+        and node.func.attr == "over"
+        and isinstance(node.func.value, ast.Call)
+    )
+
+
+def path_roots(node, exclude=()):
+    """Return set of the first names of all paths like `publisher.name`.
+
+    Nodes in exclude are skipped.
+
+    """
+    roots = set()
+    if node in exclude:
+        pass
+    elif isinstance(node, ast.Name):
+        roots.add(node.id)
+    elif isinstance(node, ast.Attribute):
+        roots |= path_roots(node.value, exclude)
+    elif is_window_call(node):
+        roots |= path_roots(node.func.value, exclude)
+        for keyword in node.keywords:
+            roots |= path_roots(keyword.value, exclude)
+    elif isinstance(node, ast.Call):
+        # the function name is not a path
+        for arg in node.args:
+            roots |= path_roots(arg, exclude)
+    elif not isinstance(node, ast.Set):
+        # a set is a context variable like {name}
+        for child in ast.iter_child_nodes(node):
+            roots |= path_roots(child, exclude)
+    return roots
+
+
+def conjuncts(node):
+    """Return list of the expressions joined by AND in node."""
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        return [c for value in node.values for c in conjuncts(value)]
+    return [node]
+
+
+def shared_sources(*sources):
+    """Return the set of names referenced by more than one '@name'."""
+    counts = Counter(
+        name for src in sources if src for name in NAMED_SOURCE_PATTERN.findall(src)
+    )
+    return {name for name, count in counts.items() if count > 1}
+
+
+def escape_percent(sql):
+    """Escape % in raw SQL since we always execute with a parameter dict."""
+    return sql.replace("%", "%%")
+
 
 @functools.lru_cache()
 def func_in_whitelist(funcname):
@@ -77,7 +526,8 @@ def index_choice0(funcname, args):
 djaq_functions = {
     "IIF": "CASE WHEN {} THEN {} ELSE {} END",
     "LIKE": "{} LIKE {}",
-    "ILIKE": "{} ILIKE {}",
+    # lower() rather than ILIKE so that an index on lower(column) can be used
+    "ILIKE": "lower({}) LIKE lower({})",
     # "CONTAINS": "{} ILIKE '%%{}%%'",
     "REGEX": "{} ~ {}",
     "CONCAT": concat,
@@ -88,14 +538,23 @@ djaq_functions = {
     "INDEX_CHOICE0": index_choice0,
     "COUNTDISTINCT": "COUNT(DISTINCT {})",
     "SUMIF": "SUM(CASE WHEN {} THEN {} ELSE {} END)",
+    "SEARCH": like_search,
+    "RANK": like_search,
+}
+
+# templates of djaq_functions that differ by vendor
+vendor_functions = {
+    # Django registers a REGEXP function for SQLite connections
+    "sqlite": {"REGEX": "{} REGEXP {}", "SEARCH": sqlite_search, "RANK": sqlite_search},
+    "postgresql": {"SEARCH": postgresql_search, "RANK": postgresql_search},
 }
 
 # which functions signal that we need to group by all columns that are not aggregate functions
 # we have to include as well our custom functions that use aggregate functions
 
 aggregate_functions = {
-    "unknown": ["avg", "count", "max", "min", "sum"],
-    "sqlite": ["avg", "count", "group_concat", "max", "min", "sum", "total"],
+    "unknown": ["avg", "count", "max", "min", "sum", "sumif"],
+    "sqlite": ["avg", "count", "group_concat", "max", "min", "sum", "sumif", "total"],
     "postgresql": ["avg", "count", "max", "min", "sum", "stddev", "variance", "sumif"],
 }
 
@@ -217,7 +676,7 @@ class ContextValidator(object):
 def build_case_statement_from_choices(field_exp, choices):
     cases = ""
     for c in choices:
-        cases += f"WHEN ({field_exp} = '{c[0]}') THEN '{c[1]}' "
+        cases += escape_percent(f"WHEN ({field_exp} = '{c[0]}') THEN '{c[1]}' ")
     return f"""
         CASE
         {cases}
@@ -235,7 +694,7 @@ class JoinRelation(object):
         fk_relation: "JoinRelation" = None,
         fk_field=None,
         related_field=None,
-        join_type: str = "->",
+        join_type: str = None,
         alias: str = None,
     ):
 
@@ -243,7 +702,7 @@ class JoinRelation(object):
         self.fk_relation = fk_relation
         self.fk_field = fk_field
         self.related_field = related_field
-        self.join_type = join_type  # left, right, inner
+        self.join_type = join_type  # left, right, inner or None for implicit
         self.alias = alias
         self.select = ""
         self.expression_str = ""
@@ -323,6 +782,41 @@ class JoinRelation(object):
 
         return f"({s})"
 
+    @property
+    def is_to_one(self):
+        """True if the join matches at most one of our rows per joining row.
+
+        That is the case when we are joined by a foreign key referring
+        to our model.
+
+        """
+        field = self.fk_field
+        return bool(
+            field is not None
+            and (
+                getattr(field, "many_to_one", False)
+                or getattr(field, "one_to_one", False)
+            )
+            and field.concrete
+            and field.related_model is self.model
+            and field.model is not self.model
+        )
+
+    @property
+    def is_prunable(self):
+        """True if dropping the join cannot change the result rows."""
+        return self.join_type in ("->", None) and not self.alias and self.is_to_one
+
+    def fk_column(self, field):
+        """Return the column of the joining foreign key if it refers to field.
+
+        Then we don't need the join to get the value of field.
+
+        """
+        if self.is_prunable and self.fk_field.target_field == field:
+            return f'"{self.fk_field.model._meta.db_table}"."{self.fk_field.column}"'
+        return None
+
     def group_by_columns(self):
         """Return str of GROUP BY columns."""
         grouping = []
@@ -330,7 +824,8 @@ class JoinRelation(object):
         for c in self.column_expressions:
             if not self.xquery.is_aggregate_expression(c):
                 grouping.append(c)
-        return ", ".join(set(grouping))
+        # keep the order stable so the same query always has the same sql
+        return ", ".join(dict.fromkeys(grouping))
 
     def __str__(self):
         return f"Relation: {model_path(self.model)}"
@@ -354,6 +849,9 @@ class ExpressionParser(ast.NodeVisitor):
         """Return True if exp is an aggregate expression like
         `avg(price+price*0.2)`
         """
+        # window functions are computed after grouping and not grouped by
+        if WINDOW_PATTERN.search(exp):
+            return True
         s = exp.lower().strip("(").split("(")[0]
         return s in self.vendor_aggregate_functions
 
@@ -410,6 +908,57 @@ class ExpressionParser(ast.NodeVisitor):
         self.expression_context = "select"  # change to 'where' or 'func' later
         self.fstack = list()  # function stack
         self.parameters = list()  # query parameters
+        self.literals = dict()  # literals bound as parameters, by name
+        # parameters that are collections for IN, name: negated
+        self.collections = dict()
+        # fields compared with collections, to convert the values for
+        self.collection_fields = dict()
+        # temp tables of collections of the executed query, dropped by close()
+        self.temp_tables = list()
+        # named sources referenced more than once are emitted as CTEs
+        self.shared_names = set()
+        self.ctes = dict()
+        self.materialize_ctes = False
+        # source of DISTINCT ON expressions
+        self.distinct_on_src = None
+        # partition source, order source and number of rows per group
+        self.top_per_group_src = None
+        # rollup, cube or sets and the sources of the grouping expressions
+        self.grouping_sets_src = None
+        # start and end of the series of buckets of fill_gaps()
+        self.fill_gaps_src = None
+        # UNION, INTERSECT or EXCEPT and the parser of the other query
+        self.set_operations = list()
+        # parent field, start and maximum depth of a tree walk
+        self.recursive_src = None
+        # fields left out of the select that are loaded when accessed
+        self.deferred_fields = list()
+        # unit and whether it is a date by SQL of each bucket()
+        self.buckets = dict()
+        # SQL of the grouping expressions and of each grouping set
+        self.grouping_sql = list()
+        self.grouping_sets = list()
+        # SQL of the partition and order expressions of the row number
+        self.partition_sql = list()
+        self.window_order_sql = list()
+        # expression and direction of each ORDER BY expression
+        self.ranked_order_sql = list()
+        # grouped subqueries for aggregates over to-many relations by root
+        self.pre_aggregates = dict()
+        # True while visiting a top level conjunct of the where clause
+        self.null_rejecting = False
+        # tables of which where rejects rows that are all NULL
+        self.null_rejected_tables = set()
+        # patterns in where that cannot use a btree index
+        self.index_hints = list()
+        # labels by code of _display columns mapped after fetching, by index
+        self.display_choices = dict()
+        # emit CASE for _display columns, like when we are a subquery
+        self.inline_display = False
+        # the function call of the window function we are visiting
+        self.window_call = None
+        # column expressions of comparison operands are collected here
+        self.captured_columns = None
         self.context_validator_class = ContextValidator
         self.local = local
         self.unary_stack = list()
@@ -417,6 +966,10 @@ class ExpressionParser(ast.NodeVisitor):
         self.deferred_aggregations = list()
         self.distinct = False
         self.drop_empty = drop_empty
+        # seconds after which the statement is cancelled
+        self._timeout = None
+        # seconds spent executing and fetching, counted against the timeout
+        self.elapsed = 0
 
         self.add_relation(model=self.model)
 
@@ -429,13 +982,14 @@ class ExpressionParser(ast.NodeVisitor):
             self.vendor_aggregate_functions = aggregate_functions["unknown"]
         self.column_headers = list()
 
-    def clone(self):
+    def clone(self, using=None):
+        """Return a copy to be compiled again, for the database using if given."""
         p = ExpressionParser(
             self.model,
             select_src=self.select_src,
             where_src=self.where_src,
             order_by_src=self.order_by_src,
-            using=self.using,
+            using=using or self.using,
             limit=self._limit,
             offset=self._offset,
             context=copy.deepcopy(self._context),
@@ -445,6 +999,17 @@ class ExpressionParser(ast.NodeVisitor):
             drop_empty=self.drop_empty,
         )
         p.condition_node = copy.deepcopy(self.condition_node)
+        p._timeout = self._timeout
+        p.materialize_ctes = self.materialize_ctes
+        p.distinct_on_src = self.distinct_on_src
+        p.top_per_group_src = self.top_per_group_src
+        p.grouping_sets_src = copy.deepcopy(self.grouping_sets_src)
+        p.fill_gaps_src = self.fill_gaps_src
+        p.recursive_src = self.recursive_src
+        p.deferred_fields = list(self.deferred_fields)
+        p.set_operations = [
+            (op, other.clone(using)) for op, other in self.set_operations
+        ]
         p.relations = list()
         p.sql = None
         p.cursor = None
@@ -483,7 +1048,7 @@ class ExpressionParser(ast.NodeVisitor):
         fk_relation=None,
         fk_field=None,
         related_field=None,
-        join_type="->",
+        join_type=None,
         alias=None,
         field_name=None,
     ):
@@ -493,7 +1058,7 @@ class ExpressionParser(ast.NodeVisitor):
         fk_relation: an existing relation joining to us
         fk_field: the field of fk_relation used to join us
         related_field: model's field used for the join
-        join_type: kind of join, left, right, inner
+        join_type: kind of join, left, right, inner, None to infer it
         alias: alias for the relation
 
         """
@@ -580,7 +1145,9 @@ class ExpressionParser(ast.NodeVisitor):
                 # the case if we reference a onetoone but no single field
                 raise Exception("Specify a field name in the related model")
 
-            return f'"{relation.model._meta.db_table}"."{field.column}"'
+            return relation.fk_column(field) or (
+                f'"{relation.model._meta.db_table}"."{field.column}"'
+            )
         elif not relation and not len(attribute_list):
             # attr is a stand-alone name
             if not self.relations:
@@ -614,13 +1181,19 @@ class ExpressionParser(ast.NodeVisitor):
         if isinstance(field, ManyToManyField):
             link_model = get_model_from_table(field.m2m_db_table())
             fk_field = get_field_from_model(link_model, field.m2m_field_name())
-            self.add_relation(model=link_model, fk_relation=relation, fk_field=fk_field)
+            link_relation = self.add_relation(
+                model=link_model, fk_relation=relation, fk_field=fk_field
+            )
             fk_field = get_field_from_model(link_model, field.m2m_reverse_field_name())
             attr = attribute_list.pop()
             new_relation = self.add_relation(
-                model=field.related_model, fk_field=fk_field
+                model=field.related_model, fk_relation=link_relation, fk_field=fk_field
             )
             related_field = get_field_from_model(field.related_model, attr)
+            if new_relation.fk_field is fk_field:
+                a = new_relation.fk_column(related_field)
+                if a:
+                    return a
             a = f'"{field.related_model._meta.db_table}"."{related_field.column}"'
             return a
         else:
@@ -653,6 +1226,49 @@ class ExpressionParser(ast.NodeVisitor):
         ).as_sql()
         return sql, sql_params
 
+    def queryset_sql(self, queryset):
+        """Return the SQL of queryset with its parameters bound as our literals."""
+        sql, sql_params = self.queryset_source(queryset)
+        sql_params = iter(sql_params)
+
+        def bind(m):
+            # %% is an escaped %, not a parameter
+            if m.group(0) == "%%":
+                return m.group(0)
+            return self.add_literal(next(sql_params))
+
+        return re.sub("%%|%s", bind, sql)
+
+    def subquery_sql(self, parser):
+        """Return the SQL of parser with its parameters bound as our literals.
+
+        The context of parser is kept even if a name is also in our
+        context. Collections for IN stay collections.
+
+        """
+        sql, sql_params = parser.query()
+        self.parameters.extend(sql_params)
+        params = parser.sql_parameters()
+        names = {}
+
+        def bind(m):
+            name = m.group(1)
+            if name not in params:
+                # left for our context
+                return m.group(0)
+            if name not in names:
+                names[name] = self.add_literal(params[name])
+            return names[name]
+
+        sql = re.sub(PARAMETER_PATTERN, bind, sql)
+        for name, negated in parser.collections.items():
+            if name in names:
+                self.collections[names[name][1:-1]] = negated
+                if name in parser.collection_fields:
+                    field = parser.collection_fields[name]
+                    self.collection_fields[names[name][1:-1]] = field
+        return sql
+
     def emit_select(self, s):
         if not self.relations:
             # no relation created yet
@@ -690,6 +1306,122 @@ class ExpressionParser(ast.NodeVisitor):
     def single_quoted(self, s):
         return f"'{s}'"
 
+    def add_literal(self, value):
+        """Bind value as a parameter and return its placeholder.
+
+        Literals are not written into the SQL so that queries that only
+        differ by literal values have the same SQL.
+
+        """
+        name = f"{LITERAL_PREFIX}{len(self.literals)}"
+        self.literals[name] = value
+        return "{" + name + "}"
+
+    def inline_literal(self):
+        """Return True if a literal argument of the current function must be inlined."""
+        return bool(self.fstack) and (
+            self.fstack[-1]["funcname"].upper() in INLINE_LITERAL_FUNCTIONS
+        )
+
+    def in_collection_sql(self, placeholder, negated=False):
+        """Return the SQL to test membership in the collection parameter."""
+        if self.vendor == "postgresql":
+            return f" <> ALL({placeholder})" if negated else f" = ANY({placeholder})"
+        elif self.vendor == "sqlite":
+            op = "NOT IN" if negated else "IN"
+            return f" {op} (SELECT value FROM json_each({placeholder}))"
+        return f" NOT IN {placeholder}" if negated else f" IN {placeholder}"
+
+    def collection_parameter(self, node):
+        """Return the parameter name if node is a collection for IN.
+
+        That is either a context variable like `{ids}` or a named list
+        like `'@ids'`, which is bound as a literal.
+
+        """
+        if isinstance(node, ast.Set) and isinstance(node.elts[0], ast.Name):
+            return node.elts[0].id
+        value = getattr(node, "value", getattr(node, "s", None))
+        if isinstance(value, str) and value.strip().startswith("@"):
+            obj = self.resolve_name(value.strip()[1:])
+            if isinstance(obj, (list, tuple)):
+                return self.add_literal(list(obj))[1:-1]
+        return None
+
+    def bind_collections(self, sql, params, temp_tables=True):
+        """Return sql and params with collections bound for IN.
+
+        Postgresql receives an array, sqlite a json array. Collections
+        larger than DJAQ_IN_LIST_TABLE_THRESHOLD are loaded into a temp
+        table instead so the planner sees a table it can join to, unless
+        not temp_tables.
+
+        """
+        threshold = in_list_table_threshold() if temp_tables else None
+        for name, negated in self.collections.items():
+            if name not in params:
+                continue
+            values = params[name]
+            if isinstance(values, (list, tuple, set, frozenset)):
+                values = list(values)
+            else:
+                values = [values]
+            field = self.collection_fields.get(name)
+            if field is not None:
+                # like "1" from a JSON context for an integer column
+                values = [field.get_prep_value(v) for v in values]
+            if (
+                threshold is not None
+                and len(values) > threshold
+                and self.vendor in ("postgresql", "sqlite")
+            ):
+                table = self.load_collection_table(name, values)
+                op = "NOT IN" if negated else "IN"
+                sql = sql.replace(
+                    self.in_collection_sql(f"%({name})s", negated),
+                    f" {op} (SELECT value FROM {table})",
+                )
+                del params[name]
+            elif self.vendor == "postgresql":
+                params[name] = values
+            elif self.vendor == "sqlite":
+                params[name] = json.dumps(values, cls=DjangoJSONEncoder)
+            else:
+                params[name] = tuple(values)
+        return sql, params
+
+    def load_collection_table(self, name, values):
+        """Load values into a temp table for this execution and return its name.
+
+        The name is unique so that queries iterated at the same time on
+        one connection have their own tables.
+
+        """
+        table = self.connection.ops.quote_name(f"djaq_in_{uuid.uuid4().hex}")
+        with self.connection.cursor() as cursor:
+            if self.vendor == "postgresql":
+                # the column type is that of the array
+                cursor.execute(
+                    f"CREATE TEMPORARY TABLE {table} AS SELECT DISTINCT unnest(%s) AS value",
+                    [values],
+                )
+                cursor.execute(f"ANALYZE {table}")
+            else:
+                cursor.execute(
+                    f"CREATE TEMPORARY TABLE {table} AS SELECT DISTINCT value FROM json_each(%s)",
+                    [json.dumps(values, cls=DjangoJSONEncoder)],
+                )
+        self.temp_tables.append(table)
+        return table
+
+    def sql_parameters(self):
+        """Return dict of parameters for self.sql: the context and the literals."""
+        params = {}
+        if self._context:
+            params.update(self.context_validator_class(self, self._context).context())
+        params.update(self.literals)
+        return params
+
     def generic_visit(self, node):
         if not isinstance(node, ast.Load):
             #  parseprint(node)
@@ -708,17 +1440,32 @@ class ExpressionParser(ast.NodeVisitor):
         column_expression = self.push_attribute_relations(self.stack)
         if self.expression_context == "select":
             self.names.append(column_expression)
+        if self.captured_columns is not None:
+            self.captured_columns.append(column_expression)
         self.emit(column_expression)
         self.stack = []
         ast.NodeVisitor.generic_visit(self, node)
 
-    def visit_Int(self, node):
-        self.emit(node.n)
-        ast.NodeVisitor.generic_visit(self, node)
+    def visit_Constant(self, node):
+        # Python 3.8+ parses all literals as Constant
+        if node.value is None or isinstance(node.value, bool):
+            self.emit_name_constant(node.value)
+        elif isinstance(node.value, str):
+            self.emit_string(node.value)
+        elif isinstance(node.value, (int, float)):
+            self.emit_number(node.value)
+        else:
+            raise Exception(f"Unknown value: {node.value}")
 
     def visit_Num(self, node):
-        self.emit(node.n)
-        ast.NodeVisitor.generic_visit(self, node)
+        self.emit_number(node.n)
+
+    def emit_number(self, n):
+        if self.expression_context == "order_by" or self.inline_literal():
+            # ORDER BY 1 refers to the first column
+            self.emit(n)
+        else:
+            self.emit(self.add_literal(n))
 
     def visit_List(self, node):
         """Assume the list has one element, a string,
@@ -732,59 +1479,59 @@ class ExpressionParser(ast.NodeVisitor):
         return
 
     def visit_Str(self, node):
-        s = node.s
+        self.emit_string(node.s)
 
-        if node.s.strip().upper().startswith("SELECT "):
+    def emit_string(self, s):
+        if s.strip().upper().startswith("SELECT "):
             # this is a literal sql subquery
             # we only allow this if the user says we
             # are called locally (the default)
             if self.local:
-                self.emit(f"({node.s})")
-            ast.NodeVisitor.generic_visit(self, node)
+                self.emit(f"({escape_percent(s)})")
             return
 
-        if node.s.strip().startswith("@"):
-
-            # A named DjaqQuery, QuerySet, List
-            # get source
-            name = node.s[1:]
-            obj = self.resolve_name(name)
-            if isinstance(obj, self.__class__):
-                sql, sql_params = obj.query()
-                self.parameters.extend(sql_params)
-            elif isinstance(obj, list):
-                # TODO: not safe
-                # not even type checking is good here since strings
-                # can be sql expressions
-                if not self.local:
-                    raise Exception("Non-local attempt to use literal SQL")
-                sql = str(tuple(obj)).strip("(").strip(")")
-
-            elif isinstance(obj, QuerySet):
-                sql, sql_params = self.queryset_source(obj)
-                sql = self.mogrify(sql, sql_params)
+        if s.strip().startswith("@"):
+            name = s.strip()[1:]
+            if name in self.shared_names:
+                if name not in self.ctes:
+                    self.ctes[name] = self.named_source_sql(name)
+                self.emit(f"(SELECT * FROM {self.cte_name(name)})")
             else:
-                raise Exception(f"Name not found: {name}")
-
-            self.emit(f"({sql})")
+                self.emit(f"({self.named_source_sql(name)})")
             return
 
-        if "*" in node.s:
-            # quite the hack here
-            # not recommended
-            if self.relations[self.relation_index].where.endswith(" = "):
-                s = s.replace("*", "%")
-                parts = self.relations[self.relation_index].where.rpartition(" = ")
-                self.relations[self.relation_index].where = parts[0] + " LIKE "
-
-        # if node.s preceded by equals
-        # replace equals with LIKE (or ilike)
-        # and replace start with %
-        self.emit(self.single_quoted(s))
-        ast.NodeVisitor.generic_visit(self, node)
+        if self.inline_literal():
+            self.emit(self.single_quoted(s))
+        else:
+            self.emit(self.add_literal(s))
+
+    def named_source_sql(self, name):
+        """Return the SQL for a named DjaqQuery, QuerySet or list."""
+        obj = self.resolve_name(name)
+        if isinstance(obj, self.__class__):
+            return self.subquery_sql(obj)
+        elif isinstance(obj, list):
+            # lists following IN are bound by visit_Compare
+            return self.add_literal(obj)
+        elif isinstance(obj, QuerySet):
+            return self.queryset_sql(obj)
+        raise Exception(f"Name not found: {name}")
+
+    def cte_name(self, name):
+        return self.connection.ops.quote_name(f"cte_{name}")
 
     def visit_Call(self, node):
-        if node.func.id.lower() in aggregate_functions[self.vendor]:
+        if is_window_call(node):
+            self.visit_window(node)
+            return
+        if node.func.id.lower() == "bucket":
+            self.visit_bucket(node)
+            return
+        windowed = node is self.window_call
+        if windowed:
+            # the aggregate is computed over the window, not by grouping
+            self.window_call = None
+        elif node.func.id.lower() in aggregate_functions[self.vendor]:
             self.aggregate()
 
         last_context = self.expression_context
@@ -797,10 +1544,15 @@ class ExpressionParser(ast.NodeVisitor):
         fcall = self.fstack.pop()
         funcname = fcall["funcname"].upper()
 
+        if windowed and funcname in WINDOW_FUNCTIONS:
+            args = ", ".join(fcall["args"])
+            self.emit(f"{funcname}({args})")
         # if funcname in self.__class__.functions:
-        if funcname in djaq_functions:
+        elif funcname in djaq_functions:
             # Fill our custom SQL template with arguments
-            t = djaq_functions[funcname]
+            t = vendor_functions.get(self.vendor, {}).get(
+                funcname, djaq_functions[funcname]
+            )
             if isinstance(t, str):
                 self.emit(t.format(*fcall["args"]))
             elif callable(t):
@@ -816,6 +1568,141 @@ class ExpressionParser(ast.NodeVisitor):
             args = ", ".join(fcall["args"])
             self.emit(f"{funcname}({args})")
 
+    def visit_window(self, node):
+        """Emit a window function like `sum(price).over(partition=publisher)`.
+
+        Keywords of over() are `partition` and `order`, an expression or
+        a tuple of expressions, and `rows`, a tuple of the frame start
+        and end as row offsets with None for unbounded.
+
+        """
+        keywords = {k.arg: k.value for k in node.keywords}
+        unknown = set(keywords) - {"partition", "order", "rows"}
+        if unknown:
+            raise Exception(f"Unknown arguments of over(): {', '.join(unknown)}")
+
+        # compile the function into a pseudo function argument
+        last_context = self.expression_context
+        self.expression_context = "func"
+        self.fstack.append({"funcname": "OVER", "args": [""]})
+        self.window_call = node.func.value
+        self.visit(node.func.value)
+        self.window_call = None
+        function_sql = self.fstack.pop()["args"][0]
+
+        window = []
+        for keyword, clause in (("partition", "PARTITION BY"), ("order", "ORDER BY")):
+            if keyword in keywords:
+                value = keywords[keyword]
+                nodes = value.elts if isinstance(value, ast.Tuple) else [value]
+                expressions = [self.compile_order_expression(n) for n in nodes]
+                window.append(f"{clause} {', '.join(expressions)}")
+        if "rows" in keywords:
+            window.append(self.window_frame(keywords["rows"]))
+        self.expression_context = last_context
+        self.emit(f"{function_sql} OVER ({' '.join(window)})")
+
+    def visit_bucket(self, node):
+        """Emit `bucket(pubdate, "month")`, the start of the month of pubdate."""
+        unit = constant_value(node.args[1]) if len(node.args) == 2 else None
+        if unit not in BUCKET_UNITS:
+            raise Exception(
+                f"bucket() needs an expression and one of: {', '.join(BUCKET_UNITS)}"
+            )
+        last_context = self.expression_context
+        self.expression_context = "func"
+        self.fstack.append({"funcname": "BUCKET", "args": [""]})
+        self.visit(node.args[0])
+        expression = self.fstack.pop()["args"][0]
+        self.expression_context = last_context
+
+        field = self.path_field(node.args[0])
+        is_date = field is not None and field.get_internal_type() == "DateField"
+        sql = self.bucket_sql(unit, expression, is_date)
+        self.buckets[sql] = (unit, is_date)
+        self.emit(sql)
+
+    def bucket_sql(self, unit, expression, is_date):
+        """Return the SQL of the start of the unit containing expression."""
+        if self.vendor == "sqlite":
+            return escape_percent(BUCKET_UNITS[unit][0].format(expression))
+        sql = f"date_trunc('{unit}', {expression})"
+        if is_date:
+            # date_trunc() of a date is a timestamp
+            sql = f"CAST({sql} AS date)"
+        return sql
+
+    def window_frame(self, node):
+        """Return the ROWS BETWEEN clause for a tuple like `(-3, 0)`."""
+        if not (isinstance(node, ast.Tuple) and len(node.elts) == 2):
+            raise Exception("rows of over() must be a tuple of start and end")
+        bounds = []
+        for i, bound in enumerate(node.elts):
+            value = constant_value(bound)
+            if isinstance(bound, ast.UnaryOp) and isinstance(bound.op, ast.USub):
+                operand = constant_value(bound.operand)
+                value = -operand if type(operand) is int else None
+            if is_none(bound):
+                bounds.append(
+                    "UNBOUNDED PRECEDING" if i == 0 else "UNBOUNDED FOLLOWING"
+                )
+            elif type(value) is not int:
+                raise Exception("Bounds of rows of over() must be integers or None")
+            elif value == 0:
+                bounds.append("CURRENT ROW")
+            elif value < 0:
+                bounds.append(f"{-value} PRECEDING")
+            else:
+                bounds.append(f"{value} FOLLOWING")
+        return f"ROWS BETWEEN {bounds[0]} AND {bounds[1]}"
+
+    def visit_Compare(self, node):
+        columns = None
+        if self.null_rejecting and self.expression_context == "where":
+            if all(
+                isinstance(op, NULL_REJECTING_OPERATORS)
+                or (isinstance(op, ast.IsNot) and is_none(comparator))
+                for op, comparator in zip(node.ops, node.comparators)
+            ):
+                columns = []
+        null_rejecting = self.null_rejecting
+        self.null_rejecting = False
+
+        self.visit_operand(node.left, columns)
+        for op, comparator in zip(node.ops, node.comparators):
+            if isinstance(op, (ast.In, ast.NotIn)):
+                name = self.collection_parameter(comparator)
+                if name:
+                    negated = isinstance(op, ast.NotIn)
+                    self.collections[name] = negated
+                    field = self.path_field(node.left)
+                    if field is not None and field.concrete:
+                        self.collection_fields[name] = field
+                    self.emit(self.in_collection_sql("{" + name + "}", negated))
+                    continue
+            self.visit(op)
+            self.visit_operand(comparator, columns)
+
+        self.null_rejecting = null_rejecting
+        for column in columns or []:
+            m = COLUMN_PATTERN.fullmatch(column)
+            if m:
+                self.null_rejected_tables.add(m.group(1))
+
+    def visit_operand(self, node, columns):
+        """Visit node and add it to columns if it is a column reference."""
+        if columns is not None and isinstance(node, (ast.Name, ast.Attribute)):
+            self.captured_columns = columns
+        self.visit(node)
+        self.captured_columns = None
+
+    def visit_UnaryOp(self, node):
+        # NOT x and -x do not reject NULLs for us
+        null_rejecting = self.null_rejecting
+        self.null_rejecting = False
+        ast.NodeVisitor.generic_visit(self, node)
+        self.null_rejecting = null_rejecting
+
     def visit_Add(self, node):
         self.emit(" + ")
         ast.NodeVisitor.generic_visit(self, node)
@@ -877,21 +1764,28 @@ class ExpressionParser(ast.NodeVisitor):
         ast.NodeVisitor.generic_visit(self, node)
 
     def visit_BinOp(self, node):
+        null_rejecting = self.null_rejecting
+        self.null_rejecting = False
         self.emit("(")
         ast.NodeVisitor.visit(self, node.left)
         ast.NodeVisitor.visit(self, node.op)
         ast.NodeVisitor.visit(self, node.right)
         self.emit(")")
+        self.null_rejecting = null_rejecting
 
     def visit_NameConstant(self, node):
-        if node.value is True:
+        self.emit_name_constant(node.value)
+
+    def emit_name_constant(self, value):
+        # these are few and IS NULL requires NULL in the sql
+        if value is True:
             self.emit("TRUE")
-        elif node.value is False:
+        elif value is False:
             self.emit("FALSE")
-        elif node.value is None:
+        elif value is None:
             self.emit("NULL")
         else:
-            raise Exception(f"Unknown value: {node.value}")
+            raise Exception(f"Unknown value: {value}")
 
     def visit_Set(self, node):
         self.emit("{" + node.elts[0].id + "}")
@@ -905,6 +1799,10 @@ class ExpressionParser(ast.NodeVisitor):
         ast.NodeVisitor.generic_visit(self, node)
 
     def visit_BoolOp(self, node):
+        # only conjuncts of AND must all be true
+        null_rejecting = self.null_rejecting
+        if isinstance(node.op, ast.Or):
+            self.null_rejecting = False
         self.emit("(")
         v = node.values.pop(0)
         while v:
@@ -916,6 +1814,7 @@ class ExpressionParser(ast.NodeVisitor):
             # if yes, but no context data, drop the condition
 
         self.emit(")")
+        self.null_rejecting = null_rejecting
 
     def visit_And(self, node):
         self.emit(" AND ")
@@ -928,8 +1827,11 @@ class ExpressionParser(ast.NodeVisitor):
             self.emit("(")
         for i, el in enumerate(node.elts):
             ast.NodeVisitor.visit(self, el)
-            exp = self.relations[self.relation_index].expression_str.strip("(")
-            self.push_column_expression(exp.strip(", "))
+            exp = self.relations[self.relation_index].expression_str.strip(", ")
+            if exp.startswith("(") and exp.count("(") > exp.count(")"):
+                # opening paren of a tuple
+                exp = exp[1:]
+            self.push_column_expression(exp)
             self.relations[self.relation_index].expression_str = ""
             if not i == len(node.elts) - 1:
                 self.emit(", ")
@@ -959,6 +1861,8 @@ class ExpressionParser(ast.NodeVisitor):
             column_expression = self.push_attribute_relations(self.stack)
             if self.expression_context == "select":
                 self.names.append(column_expression)
+            if self.captured_columns is not None:
+                self.captured_columns.append(column_expression)
             self.emit(column_expression)
         self.stack = []
 
@@ -1051,80 +1955,878 @@ class ExpressionParser(ast.NodeVisitor):
         # self.column_headers.extend([c[1] for c in column_tuples])
         self.column_headers = [c[1] for c in column_tuples]
         transformed_select_src = ", ".join([c[0] for c in column_tuples])
+        select_tree = ast.parse(transformed_select_src)
+        where_tree = ast.parse(where_src) if where_src else None
+        if where_tree:
+            where_tree = SargableDates(self).visit(where_tree)
+            where_tree = StringPatterns(self).visit(where_tree)
+        order_by_tree = ast.parse(order_by_src) if order_by_src else None
+        select_tree = self.rewrite_pre_aggregates(
+            select_tree, [t for t in (where_tree, order_by_tree) if t]
+        )
+        # the labels of other queries of a set operation are not codes
+        if not (self.inline_display or self.set_operations):
+            select_tree = self.rewrite_display_columns(select_tree)
+        partition_src, window_order_src = self.window_sources()
+        window_trees = [
+            ast.parse(src) for src in (partition_src, window_order_src) if src
+        ]
+        if self.grouping_sets_src:
+            window_trees += [ast.parse(src) for src in self.grouping_sets_src[1] if src]
+        # paths outside of where need joins
+        joined_roots = path_roots(select_tree)
+        for tree in [order_by_tree] + window_trees:
+            if tree:
+                joined_roots |= path_roots(tree)
+
+        is_tuple = isinstance(select_tree.body[0].value, ast.Tuple)
         self.expression_context = "select"
-        self.visit(ast.parse(transformed_select_src))
+        self.visit(select_tree)
+        master_relation = self.relations[0]
+        # SQL of each select expression
+        if is_tuple:
+            self.select_columns = list(master_relation.column_expressions)
+        else:
+            self.select_columns = [master_relation.select]
 
         if where_src:
             self.expression_context = "where"
-            self.visit(ast.parse(where_src))
+            self.null_rejecting = True
+            self.visit(self.rewrite_semi_joins(where_tree, joined_roots))
+            self.null_rejecting = False
 
-        if order_by_src:
+        if order_by_tree:
             self.expression_context = "order_by"
-            self.visit(ast.parse(order_by_src))
+            self.visit(order_by_tree)
+
+        if partition_src:
+            self.partition_sql = self.compile_order_list(partition_src)
+        if window_order_src:
+            self.window_order_sql = self.compile_order_list(window_order_src)
+        if self.grouping_sets_src:
+            self.compile_grouping_sets()
+        if self.tree_columns:
+            self.select_columns += ["djaq_tree.djaq_depth", "djaq_tree.djaq_path"]
+            self.column_headers += ["depth", "path"]
+        if (partition_src or self.grouping_sql or self.set_operations) and order_by_src:
+            # the outer query of ranked rows orders by these as columns
+            self.ranked_order_sql = [
+                (sql[: -len(" DESC")], " DESC") if sql.endswith(" DESC") else (sql, "")
+                for sql in self.compile_order_list(order_by_src)
+            ]
 
         # need this to group-by where we need grouping
         for relation_index in self.deferred_aggregations:
             self.relations[relation_index].group_by = True
 
-    def build_sql_statement(self, outer_scope=None):
-        """Generate the SQL. Assumes source is parsed.
+    def window_sources(self):
+        """Return the sources of the partition and order of the row number."""
+        if self.top_per_group_src:
+            return self.top_per_group_src[:2]
+        if self.distinct_on_src:
+            return self.distinct_on_src, self.order_by_src
+        return None, None
 
-        No model lookups are done here.
+    def compile_grouping_sets(self):
+        """Compile the grouping expressions and sets and add the grouping flags.
 
-        `outerscope` is the relation enclosing us if we are a subquery.
+        For each grouping expression, a column `grouping_<name>` is 1
+        in rows where the expression is aggregated over, like totals.
 
-        self.sql is assigned to
+        """
+        kind, sources = self.grouping_sets_src
+        sets = [self.compile_order_list(src) if src else [] for src in sources]
+        self.grouping_sql = list(dict.fromkeys(e for s in sets for e in s))
+        if kind == "rollup":
+            expressions = sets[0]
+            sets = [expressions[:i] for i in range(len(expressions), -1, -1)]
+        elif kind == "cube":
+            expressions = sets[0]
+            sets = [
+                [e for i, e in enumerate(expressions) if mask & (1 << i)]
+                for mask in range(2 ** len(expressions) - 1, -1, -1)
+            ]
+        self.grouping_sets = sets
+
+        for expression in self.grouping_sql:
+            if expression in self.select_columns:
+                name = self.column_headers[self.select_columns.index(expression)]
+            else:
+                name = slugify(expression).replace("-", "_")
+            self.column_headers.append(f"grouping_{name}")
+
+    def grouping_clause(self):
+        """Return the GROUP BY clause of our grouping sets for Postgresql."""
+        kind, _ = self.grouping_sets_src
+        if kind in ("rollup", "cube"):
+            return f"{kind.upper()} ({', '.join(self.grouping_sql)})"
+        sets = ", ".join(f"({', '.join(s)})" for s in self.grouping_sets)
+        return f"GROUPING SETS ({sets})"
+
+    def grouping_union(self, body):
+        """Return a UNION ALL of a grouped query for each grouping set.
+
+        body is the SQL from FROM up to the WHERE clause. This is for
+        vendors without GROUPING SETS, like SQLite.
 
         """
+        queries = []
+        for grouping_set in self.grouping_sets:
+            columns = [
+                "NULL" if c in self.grouping_sql and c not in grouping_set else c
+                for c in self.select_columns
+            ]
+            columns += ["0" if e in grouping_set else "1" for e in self.grouping_sql]
+            sql = f"SELECT {', '.join(columns)}{body}"
+            if grouping_set:
+                sql += f" GROUP BY {', '.join(grouping_set)}"
+            queries.append(sql)
+        return " UNION ALL ".join(queries)
+
+    def positional_order_by(self):
+        """Return ORDER BY of a union by position of the select expressions."""
+        order = []
+        for expression, direction in self.ranked_order_sql:
+            if expression not in self.select_columns:
+                raise Exception(
+                    "Order by a select expression with set operations or "
+                    f"grouping sets on {self.vendor}"
+                )
+            order.append(f"{self.select_columns.index(expression) + 1}{direction}")
+        if order:
+            return f" ORDER BY {', '.join(order)}"
+        return ""
+
+    def compile_order_expression(self, node):
+        """Emit node as an ORDER BY expression and return its SQL."""
+        relation = self.relations[0]
+        order_by, relation.order_by = relation.order_by, ""
+        last_context, self.expression_context = self.expression_context, "order_by"
+        self.visit(node)
+        self.expression_context = last_context
+        sql, relation.order_by = relation.order_by, order_by
+        return sql
+
+    def compile_order_list(self, src):
+        """Return list of SQL of the comma separated ORDER BY expressions in src."""
+        expression = ast.parse(src).body[0].value
+        nodes = expression.elts if isinstance(expression, ast.Tuple) else [expression]
+        return [self.compile_order_expression(node) for node in nodes]
+
+    def index_hint(self, node, pattern, index):
+        """Record that matching node with pattern needs an index of kind index."""
+        hint = {
+            "field": path_name(unwrap_lower(node)),
+            "pattern": pattern,
+            "index": index,
+        }
+        self.index_hints.append(hint)
+        logger.info(
+            "Pattern %r on %s cannot use a btree index, consider a %s index",
+            pattern,
+            hint["field"],
+            index,
+        )
 
-        # self.relations.reverse()
-        # master_relation = self.relations.pop()
-        # self.relations.reverse()
-        master_relation = self.relations[0]
+    def path_field(self, node):
+        """Return the model field of a path like `publisher.owner.name` or None."""
+        names = []
+        while isinstance(node, ast.Attribute):
+            names.insert(0, node.attr)
+            node = node.value
+        if not isinstance(node, ast.Name):
+            return None
+        names.insert(0, node.id)
+        model = self.model
+        field = None
+        for name in names:
+            if model is None:
+                return None
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                return None
+            model = field.related_model if field.is_relation else None
+        return field
+
+    def date_part(self, node):
+        """Return path and part if node is a part of a date like `pubdate.year`."""
+        if not (isinstance(node, ast.Attribute) and node.attr.lower() in DATE_PARTS):
+            return None
+        field = self.path_field(node.value)
+        if field is None:
+            return None
+        part = node.attr.lower()
+        internal_type = field.get_internal_type()
+        if internal_type == "DateTimeField" or (
+            internal_type == "DateField" and part != "date"
+        ):
+            return node.value, part
+        return None
 
-        ## SELECT EXPRESSIONS
-        select = master_relation.select
+    def date_bounds(self, part, node):
+        """Return the range of dates for which part equals node or None.
 
-        if len(self.relations) > 1:
-            for r in self.relations[1:]:
-                if r.select:
-                    select = f"{select}, {r.select}"
+        We can only do this for a year or a date. A context variable
+        is only supported on PostgreSQL where we can build the bounds
+        in SQL.
 
-        if self.distinct:
-            s = f"SELECT DISTINCT {select} FROM {master_relation.model_table}"
+        """
+        value = constant_value(node)
+        if part == "year" and type(value) is int and 0 < value < 9999:
+            bounds = date(value, 1, 1), date(value + 1, 1, 1)
+        elif part == "date" and isinstance(value, str):
+            try:
+                day = date.fromisoformat(value)
+                bounds = day, day + timedelta(days=1)
+            except (ValueError, OverflowError):
+                return None
+        elif isinstance(node, ast.Set) and self.vendor == "postgresql":
+            one = ast.Constant(value=1)
+            if part == "year":
+                next_year = ast.BinOp(left=node, op=ast.Add(), right=one)
+                return tuple(
+                    ast.Call(
+                        func=ast.Name(id="make_date", ctx=ast.Load()),
+                        args=[copy.deepcopy(year), one, one],
+                        keywords=[],
+                    )
+                    for year in (node, next_year)
+                )
+            if part == "date":
+                lower = ast.Call(
+                    func=ast.Name(id="cast", ctx=ast.Load()),
+                    args=[node, ast.Constant(value="date")],
+                    keywords=[],
+                )
+                return lower, ast.BinOp(left=lower, op=ast.Add(), right=one)
+            return None
         else:
-            s = f"SELECT {select} FROM {master_relation.model_table}"
+            return None
+        return tuple(ast.Constant(value=d.isoformat()) for d in bounds)
 
-        ## FROM JOINS
-        if not outer_scope:
-            for relation in self.relations[1:]:
-                s += f" {relation.join_operator} {relation.model_table} {relation.alias or ''} ON {relation.join_condition_expression} "
+    def date_range_compare(self, node):
+        """Return node as a comparison with a range of dates or None."""
+        if len(node.ops) != 1:
+            return None
+        operand = self.date_part(node.left)
+        if not operand:
+            return None
+        path, part = operand
+        bounds = self.date_bounds(part, node.comparators[0])
+        if not bounds:
+            return None
+        return date_range(path, node.ops[0], *bounds)
 
-        ## WHERE
-        where = "\n"
-        if master_relation.where:
-            where += f" WHERE {master_relation.where}"
-        for relation in self.relations[1:]:
-            if relation.where:
-                if where:
-                    where += " AND "
-                else:
-                    where += "WHERE "
-                where += relation.where
-        s += where + "\n"
+    def merge_date_parts(self, nodes):
+        """Return nodes with equalities of year, month and day of a date merged.
 
-        ## GROUP BY
-        if master_relation.group_by:
-            gb = master_relation.group_by_columns()
-            if gb:
-                s += f" GROUP BY {gb}"
+        `pubdate.year == 2020 and pubdate.month == 3` is one range,
+        March 2020, while `pubdate.month == 3` alone is not a range.
 
-        ## ORDER BY
-        order = ""
-        if master_relation.order_by:
-            order += f" ORDER BY {master_relation.order_by}"
+        """
+        parts = {}
+        for node in nodes:
+            if not (
+                isinstance(node, ast.Compare)
+                and len(node.ops) == 1
+                and isinstance(node.ops[0], ast.Eq)
+            ):
+                continue
+            operand = self.date_part(node.left)
+            value = constant_value(node.comparators[0])
+            if not operand or type(value) is not int:
+                continue
+            path, part = operand
+            parts.setdefault(ast.dump(path), {}).setdefault(part, []).append(
+                (node, path, value)
+            )
+
+        replacements = {}
+        for found in parts.values():
+            if not ("year" in found and "month" in found):
+                continue
+            if any(len(found[part]) > 1 for part in found) or "date" in found:
+                continue
+            year, month = found["year"][0][2], found["month"][0][2]
+            try:
+                if "day" in found:
+                    lower = date(year, month, found["day"][0][2])
+                    upper = lower + timedelta(days=1)
+                else:
+                    lower = date(year, month, 1)
+                    upper = (lower + timedelta(days=31)).replace(day=1)
+            except (ValueError, OverflowError):
+                continue
+            merged = [entry[0] for entries in found.values() for entry in entries]
+            replacements[id(merged[0])] = date_range(
+                found["year"][0][1],
+                ast.Eq(),
+                ast.Constant(value=lower.isoformat()),
+                ast.Constant(value=upper.isoformat()),
+            )
+            for node in merged[1:]:
+                replacements[id(node)] = None
+
+        if not replacements:
+            return nodes
+        return [
+            replacements.get(id(node), node)
+            for node in nodes
+            if replacements.get(id(node), node) is not None
+        ]
+
+    def rewrite_display_columns(self, select_tree):
+        """Select the codes of `_display` columns and record their labels.
+
+        Instead of a CASE expression with all choices, we select the
+        column and map codes to labels in Python after fetching.
+
+        """
+        expression = select_tree.body[0].value
+        columns = expression.elts if isinstance(expression, ast.Tuple) else [expression]
+        for i, node in enumerate(columns):
+            if isinstance(node, ast.Name) and node.id.endswith("_display"):
+                column = ast.Name(id=node.id[:-8], ctx=ast.Load())
+            elif isinstance(node, ast.Attribute) and node.attr.endswith("_display"):
+                column = ast.Attribute(
+                    value=node.value, attr=node.attr[:-8], ctx=ast.Load()
+                )
+            else:
+                continue
+            field = self.path_field(column)
+            if field is None or not field.choices:
+                continue
+            choices = {code: str(label) for code, label in field.flatchoices}
+            # codes with the same label are one group or distinct value in SQL
+            if len(set(choices.values())) < len(choices):
+                continue
+            self.display_choices[i] = choices
+            if isinstance(expression, ast.Tuple):
+                expression.elts[i] = column
+            else:
+                select_tree.body[0].value = column
+        return select_tree
+
+    def map_display(self, rows):
+        """Return rows with the codes of `_display` columns replaced by labels."""
+        if not rows:
+            return rows
+        columns = list(zip(*rows))
+        for i, choices in self.display_choices.items():
+            columns[i] = map(choices.get, columns[i])
+        return list(zip(*columns))
+
+    def to_many_field(self, name):
+        """Return the field of the master model if name is a to-many relation."""
+        try:
+            field = self.model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        # the subquery cannot use the same table as we do
+        if (field.many_to_many or field.one_to_many) and not (
+            field.related_model is self.model
+        ):
+            return field
+        return None
+
+    def returns_to_model(self, node):
+        """Return True if a path in node leads back to our model like `book.publisher`.
+
+        The subquery would refer to its own copy of our table instead
+        of correlating with ours, since tables are not aliased.
+
+        """
+        for path in ast.walk(node):
+            names = []
+            while isinstance(path, ast.Attribute):
+                names.insert(0, path.attr)
+                path = path.value
+            if not (names and isinstance(path, ast.Name)):
+                continue
+            model = self.model
+            for name in [path.id] + names[:-1]:
+                try:
+                    field = model._meta.get_field(name)
+                except FieldDoesNotExist:
+                    return True
+                model = field.related_model
+                if model is None:
+                    break
+                if model._meta.db_table == self.model._meta.db_table:
+                    return True
+        return False
+
+    def is_semi_join_condition(self, node, root):
+        """Return True if node only refers to root and rejects rows if root is NULL."""
+        if not path_roots(node) == {root} or self.returns_to_model(node):
+            return False
+
+        def rooted(operand):
+            operand = unwrap_lower(operand)
+            return isinstance(operand, ast.Attribute) and path_roots(operand) == {root}
+
+        if isinstance(node, ast.Compare):
+            operands = [node.left] + node.comparators
+            return any(rooted(o) for o in operands) and all(
+                isinstance(op, NULL_REJECTING_OPERATORS)
+                or (isinstance(op, ast.IsNot) and is_none(comparator))
+                for op, comparator in zip(node.ops, node.comparators)
+            )
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            return (
+                node.func.id.upper() in NULL_REJECTING_FUNCTIONS
+                and bool(node.args)
+                and rooted(node.args[0])
+            )
+        return False
+
+    def rewrite_semi_joins(self, tree, joined_roots):
+        """Replace conditions on to-many relations with SemiJoin nodes.
+
+        A to-many relation that is only referred to by top level
+        conjuncts of the where clause is tested with EXISTS, so that
+        master rows are not multiplied by the join.
+
+        """
+        expression = tree.body[0].value
+        nodes = conjuncts(expression)
+        semi_joins = {}
+        rejected = set(joined_roots)
+        for node in nodes:
+            for root in path_roots(node):
+                if root in rejected or not self.to_many_field(root):
+                    continue
+                if self.is_semi_join_condition(node, root):
+                    semi_joins.setdefault(root, []).append(node)
+                else:
+                    rejected.add(root)
+        for root in rejected:
+            semi_joins.pop(root, None)
+        if not semi_joins:
+            return tree
+
+        values = []
+        for node in nodes:
+            roots = [root for root in semi_joins if node in semi_joins[root]]
+            if not roots:
+                values.append(node)
+            elif semi_joins[roots[0]][0] is node:
+                semi_join = SemiJoin(conditions=semi_joins[roots[0]])
+                semi_join.root = roots[0]
+                semi_join.field = self.to_many_field(roots[0])
+                values.append(semi_join)
+        if len(values) == 1:
+            tree.body[0].value = values[0]
+        else:
+            tree.body[0].value = ast.BoolOp(op=ast.And(), values=values)
+        return tree
+
+    def to_many_subquery(self, field):
+        """Return a parser for a subquery over the to-many field.
+
+        Also return the foreign key of the subquery's model to our
+        model and the name of the field to use instead of the root of
+        paths. The subquery shares our parameters.
+
+        """
+        if field.many_to_many:
+            if isinstance(field, ManyToManyField):
+                inner_model = field.remote_field.through
+                outer_fk_name = field.m2m_field_name()
+                inner_name = field.m2m_reverse_field_name()
+            else:
+                # reverse side of a ManyToManyField
+                inner_model = field.through
+                outer_fk_name = field.field.m2m_reverse_field_name()
+                inner_name = field.field.m2m_field_name()
+        else:
+            inner_model = field.related_model
+            outer_fk_name = field.field.name
+            inner_name = None
+        find_model_class(field.related_model._meta.label, whitelist=self.whitelist)
+        outer_fk = inner_model._meta.get_field(outer_fk_name)
+
+        sub = self.__class__(
+            model=inner_model,
+            using=self.using,
+            whitelist=self.whitelist,
+            local=self.local,
+        )
+        sub.literals = self.literals
+        sub.collections = self.collections
+        sub.collection_fields = self.collection_fields
+        return sub, outer_fk, inner_name
+
+    def visit_SemiJoin(self, node):
+        sub, outer_fk, inner_name = self.to_many_subquery(node.field)
+        inner_model = sub.model
+        renamer = RootRenamer(node.root, inner_name)
+        conditions = [renamer.visit(c) for c in node.conditions]
+        sub.expression_context = "select"
+        sub.visit(ast.parse(inner_model._meta.pk.name))
+        sub.expression_context = "where"
+        sub.null_rejecting = True
+        if len(conditions) == 1:
+            sub.visit(conditions[0])
+        else:
+            sub.visit(ast.BoolOp(op=ast.And(), values=conditions))
+        sub.null_rejecting = False
+        sub.prune_relations()
+        sub.infer_inner_joins()
+        inner = sub.relations[0]
+        correlation = (
+            f'"{inner.model_table}"."{outer_fk.column}"'
+            f' = "{self.model._meta.db_table}"."{outer_fk.target_field.column}"'
+        )
+        inner.where = f"{correlation} AND {inner.where}"
+        sql = sub.build_sql_statement()
+        self.emit(f"EXISTS ({sql})")
+
+    def pre_aggregate_root(self, node):
+        """Return the root if node is an aggregate we can compute in a subquery.
+
+        That is the case for an aggregate whose arguments only refer to
+        a single to-many relation.
+
+        """
+        if not (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id.lower() in PRE_AGGREGATE_FUNCTIONS
+            and node.args
+            and isinstance(node.args[0], ast.Attribute)
+        ):
+            return None
+        roots = path_roots(node)
+        if len(roots) == 1:
+            root = roots.pop()
+            if self.to_many_field(root):
+                return root
+        return None
+
+    def rewrite_pre_aggregates(self, select_tree, other_trees):
+        """Replace aggregates over to-many relations with PreAggregate nodes.
+
+        Joining a to-many relation multiplies our rows, and joining
+        several gives wrong aggregates. We aggregate each relation in a
+        subquery grouped by our key instead and join that. We only do
+        this if no other part of the query joins a to-many relation.
+
+        """
+        # an aggregate of a window function is not grouped by our key
+        if any(is_window_call(node) for node in ast.walk(select_tree)):
+            return select_tree
+        candidates = {}
+
+        def collect(node):
+            root = self.pre_aggregate_root(node)
+            if root:
+                candidates[id(node)] = (node, root)
+            else:
+                for child in ast.iter_child_nodes(node):
+                    collect(child)
+
+        collect(select_tree)
+        if not candidates:
+            return select_tree
+
+        exclude = [node for node, _ in candidates.values()]
+        roots = path_roots(select_tree, exclude)
+        for tree in other_trees:
+            roots |= path_roots(tree)
+        if any(self.to_many_field(root) for root in roots):
+            return select_tree
+
+        replacements = {}
+        for key, (node, root) in candidates.items():
+            pre_aggregate = PreAggregate(args=node.args)
+            pre_aggregate.root = root
+            pre_aggregate.field = self.to_many_field(root)
+            pre_aggregate.func = node.func.id.lower()
+            replacements[key] = pre_aggregate
+        return NodeReplacer(replacements).visit(select_tree)
+
+    def pre_aggregate_alias(self, root):
+        return self.connection.ops.quote_name(f"djaq_agg_{root}")
+
+    def compile_select_expression(self, node):
+        """Emit node as a select expression and return its SQL."""
+        relation = self.relations[0]
+        start = len(relation.select)
+        self.expression_context = "select"
+        self.visit(node)
+        return relation.select[start:]
+
+    def visit_PreAggregate(self, node):
+        self.aggregate()
+        entry = self.pre_aggregates.get(node.root)
+        if entry is None:
+            sub, outer_fk, inner_name = self.to_many_subquery(node.field)
+            entry = self.pre_aggregates[node.root] = {
+                "parser": sub,
+                "outer_fk": outer_fk,
+                "renamer": RootRenamer(node.root, inner_name),
+                "columns": [],
+            }
+        args = [entry["renamer"].visit(copy.deepcopy(arg)) for arg in node.args]
+        alias = self.pre_aggregate_alias(node.root)
+
+        def column(func):
+            """Add an aggregate column to the subquery and return its reference."""
+            call = ast.Call(
+                func=ast.Name(id=func, ctx=ast.Load()),
+                args=copy.deepcopy(args),
+                keywords=[],
+            )
+            name = f"a{len(entry['columns'])}"
+            sql = entry["parser"].compile_select_expression(call)
+            entry["columns"].append((sql, name))
+            return f"{alias}.{name}"
+
+        # combine the aggregates of the subquery
+        if node.func == "count":
+            count = f"SUM(COALESCE({column('count')}, 0))"
+            if self.vendor == "postgresql":
+                # the sum of bigint is numeric but a count is an integer
+                count += "::bigint"
+            self.emit(count)
+        elif node.func == "avg":
+            total = column("sum")
+            count = column("count")
+            self.emit(f"SUM({total}) * 1.0 / NULLIF(SUM({count}), 0)")
+        else:
+            self.emit(f"{node.func.upper()}({column(node.func)})")
+
+    def pre_aggregate_joins(self):
+        """Return the SQL joining the subqueries of PreAggregate nodes."""
+        s = ""
+        for root, entry in self.pre_aggregates.items():
+            sub = entry["parser"]
+            sub.prune_relations()
+            sub.infer_inner_joins()
+            inner = sub.relations[0]
+            outer_fk = entry["outer_fk"]
+            key = f'"{inner.model_table}"."{outer_fk.column}"'
+            columns = ", ".join(f"{sql} AS {name}" for sql, name in entry["columns"])
+            sql = (
+                f"SELECT {key} AS _djaq_key, {columns} FROM {inner.model_table}"
+                f"{sub.join_sql()} GROUP BY {key}"
+            )
+            alias = self.pre_aggregate_alias(root)
+            s += (
+                f" LEFT JOIN ({sql}) {alias} ON {alias}._djaq_key"
+                f' = "{self.model._meta.db_table}"."{outer_fk.target_field.column}" '
+            )
+        return s
+
+    def join_sql(self):
+        """Return the SQL joining our relations to the master relation."""
+        s = ""
         for relation in self.relations[1:]:
-            if relation.order_by:
+            s += f" {relation.join_operator} {relation.model_table} {relation.alias or ''} ON {relation.join_condition_expression} "
+        return s
+
+    def prune_relations(self):
+        """Drop joins that nothing refers to.
+
+        Only joins that cannot change the result rows are dropped: left
+        joins without alias by a foreign key referring to the joined
+        model. We repeat until nothing changes since dropping a join can
+        leave the relation it joined through unreferenced.
+
+        """
+        text = (
+            " ".join(f"{r.select} {r.where} {r.order_by}" for r in self.relations)
+            + " ".join(self.ctes.values())
+            + " ".join(self.partition_sql + self.window_order_sql + self.grouping_sql)
+        )
+        pruned = True
+        while pruned:
+            pruned = False
+            for relation in self.relations[1:]:
+                if not relation.is_prunable:
+                    continue
+                reference = f'"{relation.model_table}".'
+                if reference in text:
+                    continue
+                if any(
+                    reference in r.join_condition_expression
+                    for r in self.relations[1:]
+                    if r is not relation
+                ):
+                    continue
+                self.relations.remove(relation)
+                pruned = True
+                break
+
+    def parent_relation(self, relation):
+        """Return the relation that relation is joined to."""
+        if relation.fk_relation:
+            return relation.fk_relation
+        if relation.fk_field is not None:
+            for r in self.relations:
+                if r is not relation and r.model is relation.fk_field.model:
+                    return r
+        return None
+
+    def infer_inner_joins(self):
+        """Use INNER JOIN for implicit joins where it gives the same rows.
+
+        That is the case if the where clause rejects rows where the
+        joined relation is NULL, and for a non-null foreign key to the
+        joined model as long as the relation joining us is not NULL.
+        Explicit join types are kept.
+
+        """
+        master = self.relations[0]
+        for relation in self.relations[1:]:
+            if relation.alias or relation.model_table not in self.null_rejected_tables:
+                continue
+            # a non-NULL relation means the relations joining it are not NULL
+            r = relation
+            while r is not None and r is not master and r.join_type in (None, "<>"):
+                r.join_type = "<>"
+                r = self.parent_relation(r)
+
+        changed = True
+        while changed:
+            changed = False
+            for relation in self.relations[1:]:
+                if (
+                    relation.join_type is None
+                    and relation.is_to_one
+                    and not relation.fk_field.null
+                ):
+                    parent = self.parent_relation(relation)
+                    if parent is master or (parent and parent.join_type == "<>"):
+                        relation.join_type = "<>"
+                        changed = True
+
+    def build_sql_statement(self, outer_scope=None):
+        """Generate the SQL. Assumes source is parsed.
+
+        No model lookups are done here.
+
+        `outerscope` is the relation enclosing us if we are a subquery.
+
+        self.sql is assigned to
+
+        """
+
+        # self.relations.reverse()
+        # master_relation = self.relations.pop()
+        # self.relations.reverse()
+        master_relation = self.relations[0]
+
+        ## SELECT EXPRESSIONS
+        select = master_relation.select
+
+        if len(self.relations) > 1:
+            for r in self.relations[1:]:
+                if r.select:
+                    select = f"{select}, {r.select}"
+
+        distinct_on = self.distinct_on_src and self.vendor == "postgresql"
+        ranked = self.top_per_group_src or (self.distinct_on_src and not distinct_on)
+        grouping_sets = bool(self.grouping_sql) and self.vendor == "postgresql"
+        grouping_union = bool(self.grouping_sql) and not grouping_sets
+        filled = self.fill_gaps_src is not None
+        if filled and (ranked or self.grouping_sql):
+            raise Exception(
+                "fill_gaps() cannot be combined with ranking or grouping sets"
+            )
+        if self.tree_columns and not (ranked or filled):
+            select = f"{select}, djaq_tree.djaq_depth, djaq_tree.djaq_path"
+        if ranked:
+            select = self.ranked_select()
+        if filled:
+            select = ", ".join(
+                f"{c} AS djaq_c{i}" for i, c in enumerate(self.select_columns)
+            )
+        if grouping_sets:
+            flags = ", ".join(f"GROUPING({e})" for e in self.grouping_sql)
+            select = f"{select}, {flags}"
+        if distinct_on:
+            select = f"DISTINCT ON ({', '.join(self.partition_sql)}) {select}"
+        elif self.distinct and not ranked:
+            select = f"DISTINCT {select}"
+        select_sql = f"SELECT {select}"
+        s = f"{select_sql} FROM {master_relation.model_table}"
+
+        ## FROM JOINS
+        tree_cte = None
+        if self.recursive_src:
+            tree_cte = self.tree_cte()
+            pk = f'"{master_relation.model_table}"."{self.model._meta.pk.column}"'
+            s += f" JOIN djaq_tree ON {pk} = djaq_tree.djaq_id"
+        if not outer_scope:
+            s += self.join_sql()
+            s += self.pre_aggregate_joins()
+
+        ## WHERE
+        where = "\n"
+        if master_relation.where:
+            where += f" WHERE {master_relation.where}"
+        for relation in self.relations[1:]:
+            if relation.where:
+                if where:
+                    where += " AND "
+                else:
+                    where += "WHERE "
+                where += relation.where
+        s += where + "\n"
+
+        ## GROUP BY
+        if grouping_sets:
+            s += f" GROUP BY {self.grouping_clause()}"
+        elif grouping_union:
+            s = self.grouping_union(s[len(select_sql) :])
+        elif master_relation.group_by:
+            gb = master_relation.group_by_columns()
+            if gb:
+                s += f" GROUP BY {gb}"
+
+        if ranked:
+            s = self.ranked_statement(s)
+        gap_ctes = []
+        if filled:
+            gap_ctes, s = self.gap_filled_statement(s)
+        if self.set_operations:
+            if ranked or filled or distinct_on or grouping_union:
+                raise Exception(
+                    "Set operations cannot be combined with ranking, fill_gaps() "
+                    f"or grouping sets on {self.vendor}"
+                )
+            for i, (operator, other) in enumerate(self.set_operations):
+                s += f" {operator} {self.set_operation_sql(other, i)}"
+
+        ## ORDER BY
+        order = ""
+        if ranked:
+            order = self.ranked_order_by()
+        elif filled:
+            order = " ORDER BY djaq_series.djaq_bucket"
+        elif grouping_union or self.set_operations:
+            order = self.positional_order_by()
+        elif distinct_on:
+            # DISTINCT ON expressions must start the ORDER BY
+            partition = ", ".join(self.partition_sql)
+            if master_relation.order_by.startswith(partition):
+                order = f" ORDER BY {master_relation.order_by}"
+            elif master_relation.order_by:
+                order = f" ORDER BY {partition}, {master_relation.order_by}"
+            else:
+                order = f" ORDER BY {partition}"
+        elif master_relation.order_by:
+            order += f" ORDER BY {master_relation.order_by}"
+        elif self.tree_columns and not self.set_operations:
+            # parents before their children, siblings by primary key
+            order = " ORDER BY djaq_tree.djaq_order"
+        for relation in self.relations[1:]:
+            if relation.order_by and not (
+                ranked or grouping_union or filled or self.set_operations
+            ):
                 if not order:
                     order = " ORDER BY "
                 order += relation.order_by
@@ -1133,10 +2835,27 @@ class ExpressionParser(ast.NodeVisitor):
         s += order
 
         if self._limit:
-            s += f" LIMIT {int(self._limit)}"
+            s += f" LIMIT {self.add_literal(int(self._limit))}"
 
         if self._offset:
-            s += f" OFFSET {int(self._offset)}"
+            s += f" OFFSET {self.add_literal(int(self._offset))}"
+
+        ## WITH
+        if tree_cte:
+            gap_ctes.insert(0, tree_cte)
+        if self.ctes or gap_ctes:
+            materialized = ""
+            if self.materialize_ctes and self.vendor == "postgresql":
+                materialized = "MATERIALIZED "
+            ctes = [
+                f"{self.cte_name(name)} AS {materialized}({sql})"
+                for name, sql in self.ctes.items()
+            ]
+            # the series of buckets of SQLite is a recursive CTE
+            recursive = ""
+            if tree_cte or (gap_ctes and self.vendor == "sqlite"):
+                recursive = "RECURSIVE "
+            s = f"WITH {recursive}{', '.join(ctes + gap_ctes)} {s}"
 
         # replace variables placeholders to be valid dict placeholders
         s = re.sub(PLACEHOLDER_PATTERN, lambda x: f"%({x.group(1)})s", s)
@@ -1146,6 +2865,190 @@ class ExpressionParser(ast.NodeVisitor):
 
         return self.sql
 
+    def ranked_select(self):
+        """Return the select expressions numbered within their partition.
+
+        Columns are aliased so that the outer query can select them
+        without the row number.
+
+        """
+        columns = [f"{c} AS djaq_c{i}" for i, c in enumerate(self.select_columns)]
+        for i, (expression, _) in enumerate(self.ranked_order_sql):
+            columns.append(f"{expression} AS djaq_o{i}")
+        over = ""
+        if self.partition_sql:
+            over += f"PARTITION BY {', '.join(self.partition_sql)}"
+        if self.window_order_sql:
+            over += f" ORDER BY {', '.join(self.window_order_sql)}"
+        columns.append(f"ROW_NUMBER() OVER ({over.strip()}) AS djaq_row")
+        return ", ".join(columns)
+
+    def ranked_statement(self, sql):
+        """Return a statement that selects the top rows of each group of sql."""
+        if self.top_per_group_src:
+            n = self.add_literal(int(self.top_per_group_src[2]))
+        else:
+            n = self.add_literal(1)
+        columns = ", ".join(f"djaq_c{i}" for i in range(len(self.select_columns)))
+        distinct = "DISTINCT " if self.distinct else ""
+        return (
+            f"SELECT {distinct}{columns} FROM ({sql}) djaq_ranked "
+            f"WHERE djaq_row <= {n}"
+        )
+
+    @property
+    def tree_columns(self):
+        """Decide if depth and path of recursive() rows are selected.
+
+        Aggregates are computed over the whole tree, so rows are not
+        grouped by them.
+
+        """
+        return bool(self.recursive_src) and not self.deferred_aggregations
+
+    def tree_cte(self):
+        """Return the recursive CTE djaq_tree of the rows under the start rows.
+
+        It has the primary key, the depth, 0 for start rows, and the
+        path of primary keys from the start row separated by "/" of each
+        row. Rows already on the path are not visited again. djaq_order
+        is the path of integer keys padded to the same width without
+        separators, so that it sorts in tree order under any collation.
+
+        """
+        parent_field, start, max_depth = self.recursive_src
+        field = self.model._meta.get_field(parent_field)
+        if not (field.many_to_one and field.related_model is self.model):
+            raise Exception(
+                f"recursive() needs a foreign key of {self.model.__name__} to itself, "
+                f"not {parent_field}"
+            )
+        table = f'"{self.model._meta.db_table}"'
+        pk = f'{table}."{self.model._meta.pk.column}"'
+        if start is None:
+            anchor = f'{table}."{field.column}" IS NULL'
+        elif isinstance(start, str):
+            sub = ExpressionParser(
+                self.model,
+                select_src=self.model._meta.pk.name,
+                where_src=start,
+                using=self.using,
+                context=self._context,
+                whitelist=self.whitelist,
+                local=self.local,
+            )
+            anchor = f"{pk} IN ({self.subquery_sql(sub)})"
+        else:
+            anchor = f"{pk} = {self.add_literal(start)}"
+
+        path = f"CAST({pk} AS text)"
+        if self.model._meta.pk.get_internal_type() not in INTEGER_FIELD_TYPES:
+            key = path
+        elif self.vendor == "postgresql":
+            key = f"lpad({path}, {TREE_KEY_WIDTH}, '0')"
+        else:
+            key = f"substr('{'0' * TREE_KEY_WIDTH}' || {path}, -{TREE_KEY_WIDTH})"
+        step = (
+            f"SELECT {pk}, djaq_tree.djaq_depth + 1, "
+            f"djaq_tree.djaq_path || '/' || {path}, djaq_tree.djaq_order || {key} "
+            f"FROM {table} "
+            f'JOIN djaq_tree ON {table}."{field.column}" = djaq_tree.djaq_id '
+            f"WHERE '/' || djaq_tree.djaq_path || '/' NOT LIKE '%%/' || {path} || '/%%'"
+        )
+        if max_depth is not None:
+            step += f" AND djaq_tree.djaq_depth < {self.add_literal(int(max_depth))}"
+        return (
+            "djaq_tree(djaq_id, djaq_depth, djaq_path, djaq_order) AS ("
+            f"SELECT {pk}, 0, {path}, {key} FROM {table} WHERE {anchor} "
+            f"UNION ALL {step})"
+        )
+
+    def set_operation_sql(self, other, index):
+        """Return the SELECT of parser other as an operand of a set operation."""
+        sql = self.subquery_sql(other)
+        if len(other.select_columns) != len(self.select_columns):
+            raise Exception(
+                f"Set operation of {len(self.select_columns)} columns with a "
+                f"query of {len(other.select_columns)} columns"
+            )
+        # a subquery so that other can have an ORDER BY, LIMIT or CTEs
+        return f"SELECT * FROM ({sql}) djaq_set{index}"
+
+    def gap_filled_statement(self, sql):
+        """Return CTEs and a statement with a row for each bucket of the grouped sql.
+
+        sql selects the columns as djaq_c0, djaq_c1 and so on, one of
+        which is a bucket(). The series of buckets from the first to the
+        last, or from the start and end of fill_gaps(), is left joined
+        with sql. Counts and sums of buckets without rows are 0.
+
+        """
+        positions = [i for i, c in enumerate(self.select_columns) if c in self.buckets]
+        aggregate = re.compile(
+            rf"({'|'.join(aggregate_functions[self.vendor])})\(", re.IGNORECASE
+        )
+        grouped = [
+            i
+            for i, c in enumerate(self.select_columns)
+            if i not in positions and not aggregate.match(c)
+        ]
+        if len(positions) != 1 or grouped:
+            raise Exception("fill_gaps() needs a bucket() as the only grouped column")
+        position = positions[0]
+        unit, is_date = self.buckets[self.select_columns[position]]
+        _, step_format, step, interval = BUCKET_UNITS[unit]
+
+        bounds = []
+        for value, func in zip(self.fill_gaps_src, ("MIN", "MAX")):
+            if value is None:
+                bounds.append(f"(SELECT {func}(djaq_c{position}) FROM djaq_grouped)")
+            elif self.vendor == "sqlite":
+                bounds.append(self.bucket_sql(unit, self.add_literal(value), is_date))
+            else:
+                value = f"CAST({self.add_literal(value)} AS timestamp)"
+                bounds.append(self.bucket_sql(unit, value, is_date))
+        start, end = bounds
+
+        if self.vendor == "sqlite":
+            step_format = escape_percent(step_format)
+            series = (
+                f"SELECT {start} WHERE {start} IS NOT NULL UNION ALL "
+                f"SELECT strftime('{step_format}', djaq_bucket, '{step}') "
+                f"FROM djaq_series WHERE djaq_bucket < {end}"
+            )
+        else:
+            series = f"generate_series({start}, {end}, interval '{interval}')"
+            if is_date:
+                series = f"CAST({series} AS date)"
+            series = f"SELECT {series}"
+        ctes = [
+            f"djaq_grouped AS ({sql})",
+            f"djaq_series(djaq_bucket) AS ({series})",
+        ]
+
+        columns = []
+        for i, column in enumerate(self.select_columns):
+            if i == position:
+                columns.append("djaq_series.djaq_bucket")
+            elif re.match(r"(COUNT|SUM)\(", column, re.IGNORECASE):
+                columns.append(f"COALESCE(djaq_grouped.djaq_c{i}, 0)")
+            else:
+                columns.append(f"djaq_grouped.djaq_c{i}")
+        return ctes, (
+            f"SELECT {', '.join(columns)} FROM djaq_series "
+            f"LEFT JOIN djaq_grouped ON djaq_grouped.djaq_c{position} = "
+            "djaq_series.djaq_bucket"
+        )
+
+    def ranked_order_by(self):
+        order = [
+            f"djaq_o{i}{direction}"
+            for i, (_, direction) in enumerate(self.ranked_order_sql)
+        ]
+        if order:
+            return f" ORDER BY {', '.join(order)}"
+        return ""
+
     def rewind(self):
         """Rewind cursor by setting to None.
         The next time a generator method is called,
@@ -1163,6 +3066,10 @@ class ExpressionParser(ast.NodeVisitor):
         self._offset = offset
         return self
 
+    def timeout(self, seconds):
+        self._timeout = seconds
+        return self
+
     def context(self, context):
         """Update our context with dict context."""
         if not self._context:
@@ -1179,39 +3086,145 @@ class ExpressionParser(ast.NodeVisitor):
             self.context_validator_class = validator_class
         return self
 
-    def execute(self, context=None, count=False):
+    def execute(self, context=None, count=False, exists=False):
         """Create a cursor and execute the sql."""
 
         self.context(context)
 
         sql = self.sql
-        
 
         self.cursor = self.connection.cursor()
 
         if count:
             sql = f"SELECT COUNT(*) FROM ({sql}) c"
+        elif exists:
+            sql = f"SELECT EXISTS({sql})"
 
-        if len(self._context):
-            context = self.context_validator_class(self, self._context).context()
-            if self.verbosity:
-                conn = connections[self.using]
-                cursor = conn.cursor()
+        sql, params = self.bind_collections(sql, self.sql_parameters())
 
-                if self.verbosity:
-                    print(f"sql={sql}, params={context}")
-            self.cursor.execute(sql, context)
-        else:
-            if self.verbosity:
-                print(f"sql={sql}")
+        if self.verbosity:
+            print(f"sql={sql}, params={params}")
 
-            self.cursor.execute(sql)
+        self.elapsed = 0
+        try:
+            if self._timeout and self.vendor == "postgresql":
+                self.execute_with_statement_timeout(sql, params)
+            else:
+                with self.interruptible():
+                    self.cursor.execute(sql, params)
+        except OperationalError as e:
+            self.close()
+            self.raise_if_timeout(e)
+            raise
+
+    def execute_with_statement_timeout(self, sql, params):
+        """Execute in a transaction with a local statement_timeout.
+
+        The previous timeout is restored afterwards in case we are
+        inside an enclosing transaction.
+
+        """
+        with transaction.atomic(using=self.using), self.connection.cursor() as cursor:
+            cursor.execute("SHOW statement_timeout")
+            previous = cursor.fetchone()[0]
+            cursor.execute(f"SET LOCAL statement_timeout = {int(self._timeout * 1000)}")
+            self.cursor.execute(sql, params)
+            cursor.execute(
+                "SELECT set_config('statement_timeout', %s, true)", [previous]
+            )
+
+    @contextmanager
+    def interruptible(self):
+        """Make sqlite interrupt the statement when the timeout has passed.
+
+        The handler is only installed while we execute or fetch, so
+        that time the caller spends between fetches does not count and
+        other queries on the connection are not interrupted.
+
+        """
+        if not (self._timeout and self.vendor == "sqlite"):
+            yield
+            return
+        start = time.monotonic()
+        deadline = start + self._timeout - self.elapsed
+
+        def interrupt():
+            return time.monotonic() > deadline
+
+        db = self.connection.connection
+        db.set_progress_handler(interrupt, 1000)
+        try:
+            yield
+        finally:
+            db.set_progress_handler(None, 0)
+            self.elapsed += time.monotonic() - start
+
+    def fetch(self):
+        """Return the next block of rows of the cursor."""
+        with self.interruptible():
+            return self.cursor.fetchmany(FETCH_BLOCK_SIZE)
+
+    def raise_if_timeout(self, e):
+        """Raise QueryTimeoutException if e was caused by our timeout."""
+        if not self._timeout:
+            return
+        cause = e.__cause__
+        code = getattr(cause, "pgcode", None) or getattr(cause, "sqlstate", None)
+        if code == "57014" or (self.vendor == "sqlite" and "interrupted" in str(e)):
+            raise QueryTimeoutException(
+                f"Query cancelled after timeout of {self._timeout} seconds"
+            ) from e
+
+    def close(self):
+        """Close the cursor and drop the temp tables of collections."""
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+        tables, self.temp_tables = self.temp_tables, []
+        for table in tables:
+            try:
+                with self.connection.cursor() as cursor:
+                    cursor.execute(f"DROP TABLE IF EXISTS {table}")
+            except OperationalError:
+                # sqlite cannot drop tables while other statements are
+                # pending; temp tables are dropped with the session anyway
+                pass
+
+    def explain(self, data=None):
+        """Return the planner's estimate for the query as a dict.
+
+        Only Postgresql provides cost and row estimates. For other
+        vendors we return None.
+
+        """
+        if not self.sql:
+            self.construct()
+        if not self.vendor == "postgresql":
+            return None
+
+        self.context(data)
+        sql, params = self.bind_collections(self.sql, self.sql_parameters())
+        sql = f"EXPLAIN (FORMAT JSON) {sql}"
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql, params)
+            plan = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]["Plan"]
 
     def query(self, context=None):
         """Return source for djaqquery and parameters."""
         self.context(context)
         
-        self.construct()
+        # the outer query gets the labels, not the codes
+        inline_display, self.inline_display = self.inline_display, True
+        try:
+            self.construct()
+        finally:
+            self.inline_display = inline_display
         sql = self.sql
         return sql, self.parameters
 
@@ -1255,90 +3268,164 @@ class ExpressionParser(ast.NodeVisitor):
                 src += render_conditions(self.condition_node, self._context)
         # need to completely rebuild
         self.relations = list()
+        self.literals = dict()
+        self.collections = dict()
+        self.collection_fields = dict()
+        self.ctes = dict()
+        self.pre_aggregates = dict()
+        self.null_rejected_tables = set()
+        self.index_hints = list()
+        self.display_choices = dict()
+        self.partition_sql = list()
+        self.window_order_sql = list()
+        self.ranked_order_sql = list()
+        self.grouping_sql = list()
+        self.grouping_sets = list()
+        self.buckets = dict()
+        self.shared_names = shared_sources(self.select_src, src, self.order_by_src)
         self.add_relation(model=self.model)
         self.parse_source(self.select_src, src, self.order_by_src)
+        self.prune_relations()
+        self.infer_inner_joins()
         self.build_sql_statement()
 
-    def dicts(self, data=None):
+    def rows(self, data=None):
+        """Generator for the raw result rows.
+
+        The cursor is closed when the rows are exhausted or the caller
+        stops iterating, like when a streaming client disconnects.
+
+        """
         if not self.sql:
             self.construct()
         if not self.cursor:
             self.execute(data)
+        try:
+            while True:
+                rows = self.fetch()
+                if not rows:
+                    break
+                if self.display_choices:
+                    rows = self.map_display(rows)
+                yield from rows
+        except OperationalError as e:
+            self.raise_if_timeout(e)
+            raise
+        finally:
+            self.close()
+
+    def row_dicts(self, data=None):
+        """Yield dicts of rows and the chunk of rows they were fetched with.
+
+        The chunk is None unless fields are deferred. Then it loads the
+        deferred fields of all its rows when one of them is accessed.
+
+        """
+        if not self.deferred_fields:
+            for row in self.rows(data):
+                yield dict(zip(self.column_headers, row)), None
+            return
+        rows = self.rows(data)
         while True:
-            row = self.cursor.fetchone()
-            if row is None:
+            block = list(itertools.islice(rows, FETCH_BLOCK_SIZE))
+            if not block:
                 break
-            row_dict = dict(zip(self.column_headers, row))
-            yield row_dict
-        self.cursor = None
+            # the headers are known once the query is constructed
+            pk = self.column_headers.index(self.model._meta.pk.name)
+            chunk = DeferredChunk(
+                self.load_deferred,
+                self.model._meta.pk.name,
+                self.deferred_fields,
+                [row[pk] for row in block],
+            )
+            for row in block:
+                yield dict(zip(self.column_headers, row)), chunk
+
+    def load_deferred(self, pks):
+        """Return dict of the values of the deferred fields by primary key."""
+        pk = self.model._meta.pk.name
+        rows = self.model._default_manager.using(self.using).filter(pk__in=pks)
+        return {row.pop(pk): row for row in rows.values(pk, *self.deferred_fields)}
+
+    def dicts(self, data=None, load_deferred=False):
+        """Yield rows as dicts.
+
+        Deferred fields are loaded when accessed, or with each chunk of
+        rows if load_deferred, for rows that are serialized.
+
+        """
+        for row_dict, chunk in self.row_dicts(data):
+            if chunk and load_deferred:
+                yield chunk.complete(row_dict)
+            elif chunk:
+                yield DeferredRow(row_dict, chunk)
+            else:
+                yield row_dict
 
     def tuples(self, data=None, flat=False):
-        if not self.sql:
-            self.construct()
-        row = None
-        if not self.cursor:
-            self.execute(data)
-        while True:
-            row = self.cursor.fetchone()
-            if row is None:
-                break
+        for row in self.rows(data):
             if flat:
                 yield row[0]
             else:
                 yield row
-        self.cursor = None
 
     def json(self, data=None, encoder=DjangoJSONEncoder):
-        for d in self.dicts(data):
+        for d in self.dicts(data, load_deferred=True):
             yield json.dumps(d, cls=encoder)
-        self.cursor = None
 
     def objs(self, data=None):
-        if not self.sql:
-            self.construct()
-        if not self.cursor:
-            self.execute(data)
-        while True:
-            row = self.cursor.fetchone()
-            if row is None:
-                break
-            row_dict = dict(zip(self.column_headers, row))
-            yield DQResult(row_dict, dq=self)
-        self.cursor = None
+        for row_dict, chunk in self.row_dicts(data):
+            yield DQResult(row_dict, dq=self, chunk=chunk)
 
     def next(self, data=None):
         if not self.sql:
             self.construct()
         if not self.cursor:
             self.execute(data)
-        row = self.cursor.fetchone()
+        with self.interruptible():
+            row = self.cursor.fetchone()
+        if self.display_choices:
+            row = self.map_display([row])[0]
         row_dict = dict(zip(self.column_headers, row))
         return DQResult(row_dict, dq=self)
 
     def csv(self, data=None):
-        if not self.sql:
-            self.construct()
-        if not self.cursor:
-            self.execute(data)
-        while True:
+        """Yield rows as CSV lines, with deferred fields after the selected ones."""
+        if self.deferred_fields:
+            rows = (tuple(d.values()) for d in self.dicts(data, load_deferred=True))
+        else:
+            rows = self.rows(data)
+        for row in rows:
             output = io.StringIO()
-            row = self.cursor.fetchone()
-            if row is None:
-                break
             writer = csv.writer(output, quoting=csv.QUOTE_NONNUMERIC)
             writer.writerow(row)
             yield output.getvalue()
-        self.cursor = None
 
     def value(self, data=None):
-        for t in self.tuples(data=data):
-            return t[0]
+        rows = self.tuples(data=data)
+        try:
+            for t in rows:
+                return t[0]
+        finally:
+            rows.close()
 
     def count(self, data=None):
         if not self.sql:
             self.construct()
         self.execute(data, count=True)
-        return self.cursor.fetchone()[0]
+        try:
+            return self.cursor.fetchone()[0]
+        finally:
+            self.close()
+
+    def exists(self, data=None):
+        if not self.sql:
+            self.construct()
+        self.execute(data, exists=True)
+        try:
+            return bool(self.cursor.fetchone()[0])
+        finally:
+            self.close()
 
     def __repr__(self):
         return f"{self.__class__.__name__}"
@@ -1365,6 +3452,10 @@ class ExpressionParser(ast.NodeVisitor):
 
 
 class DjaqQuery:
+    # what Django asks of an expression in a QuerySet filter
+    contains_aggregate = False
+    contains_over_clause = False
+
     def __init__(
         self,
         model_source: Union[models.Model, str],
@@ -1372,6 +3463,7 @@ class DjaqQuery:
         name: str = None,
         names: Union[Dict, None] = None,
         whitelist=None,
+        using: str = "default",
     ):
         if isinstance(model_source, models.base.ModelBase):
             model = model_source
@@ -1382,12 +3474,18 @@ class DjaqQuery:
                 f"Type not supported for model source: {type(model_source)}"
             )
 
-        self.parser = ExpressionParser(model=model, whitelist=whitelist, name=name)
+        self.parser = ExpressionParser(
+            model=model, whitelist=whitelist, name=name, names=names, using=using
+        )
 
         if not select_source or select_source == "*":
-            select_source = ", ".join(
-                [f for f in get_model_details(model, self.parser.connection)["fields"]]
-            )
+            types = large_field_types()
+            self.parser.deferred_fields = [
+                f.name
+                for f in model._meta.fields
+                if f.get_internal_type() in types and not f.primary_key
+            ]
+            select_source = self.fields_source(model, self.parser.deferred_fields)
         elif select_source == "pk":
             select_source = model._meta.pk.name
 
@@ -1404,8 +3502,63 @@ class DjaqQuery:
             raise Exception("Expected str or list for select source")
         self.parser.select_src = select_source
 
+    def fields_source(self, model, deferred):
+        fields = get_model_details(model, self.parser.connection)["fields"]
+        return ", ".join(f for f in fields if f not in deferred)
+
+    def selected_fields(self):
+        """Return names of the selected fields or raise if we select expressions."""
+        try:
+            expression = getattr(
+                ast.parse(self.parser.select_src).body[0], "value", None
+            )
+        except SyntaxError:
+            expression = None
+        nodes = expression.elts if isinstance(expression, ast.Tuple) else [expression]
+        names = [node.id for node in nodes if isinstance(node, ast.Name)]
+        fields = {f.name for f in self.model._meta.fields}
+        if len(names) < len(nodes) or not set(names) <= fields:
+            raise Exception(
+                "Fields can only be deferred if the select is fields of the model"
+            )
+        return names
+
+    def defer(self, fields: List[str]):
+        """Leave fields out of the select, which must be fields of the model.
+
+        Deferred fields of a row of dicts() or objs() are loaded when
+        first accessed, with one query for the rows fetched with it.
+        The primary key is selected for that.
+
+        """
+        pk = self.model._meta.pk.name
+        if pk in fields:
+            raise Exception("The primary key cannot be deferred")
+        names = self.selected_fields()
+        c = self.clone()
+        deferred = [name for name in names if name in fields]
+        c.parser.deferred_fields = list(
+            dict.fromkeys(c.parser.deferred_fields + deferred)
+        )
+        selected = [name for name in names if name not in fields]
+        if pk not in selected:
+            selected.insert(0, pk)
+        c.parser.select_src = f"({', '.join(selected)})"
+        return c
+
+    def only(self, fields: List[str]):
+        """Select the primary key and those of the selected fields in fields.
+
+        The other selected fields are deferred.
+
+        """
+        pk = self.model._meta.pk.name
+        return self.defer(
+            [name for name in self.selected_fields() if name not in [pk, *fields]]
+        )
+
     def clone(self):
-        c = DjaqQuery(self.model)
+        c = DjaqQuery(self.model, using=self.parser.using)
         c.parser = self.parser.clone()
         return c
 
@@ -1437,9 +3590,9 @@ class DjaqQuery:
         c.parser.distinct = True
         return c
 
-    def dicts(self, data=None):
+    def dicts(self, data=None, load_deferred=False):
         # self.construct()
-        return self.parser.dicts(data=data)
+        return self.parser.dicts(data=data, load_deferred=load_deferred)
 
     def tuples(self, data=None, flat=False):
         # self.construct()
@@ -1449,6 +3602,42 @@ class DjaqQuery:
         # self.construct()
         return self.parser.count(data)
 
+    def limited(self, limit: int):
+        """Return a clone that fetches at most limit rows."""
+        c = self.clone()
+        if c.parser._limit is None or c.parser._limit > limit:
+            c.parser._limit = limit
+        return c
+
+    def exists(self, data=None):
+        """Return True if the query has any rows, without fetching them."""
+        return self.parser.exists(data)
+
+    def first(self, data=None):
+        """Return the first row as a DQResult or None if there are no rows."""
+        for row in self.limited(1).objs(data):
+            return row
+        return None
+
+    def get_one(self, data=None):
+        """Return the only row as a DQResult.
+
+        Raise the DoesNotExist or MultipleObjectsReturned exception of
+        the model if there is no row or more than one. At most two rows
+        are fetched to find out.
+
+        """
+        rows = list(self.limited(2).objs(data))
+        if not rows:
+            raise self.model.DoesNotExist(
+                f"{self.model._meta.object_name} matching query does not exist."
+            )
+        if len(rows) > 1:
+            raise self.model.MultipleObjectsReturned(
+                f"get_one() returned more than one {self.model._meta.object_name}"
+            )
+        return rows[0]
+
     def sql(self):
         self.construct()
         return self.parser.sql
@@ -1472,6 +3661,132 @@ class DjaqQuery:
         c.parser._offset = offset
         return c
 
+    def index_hints(self) -> List[Dict]:
+        """Return patterns of the where clause that cannot use a btree index.
+
+        Each hint is a dict with the field, the pattern and the kind of
+        index that could serve it, like `trigram`.
+
+        """
+        self.construct()
+        return self.parser.index_hints
+
+    def distinct_on(self, source: str):
+        """Return only the first row of each group with equal source expressions.
+
+        The first row is the first by `order_by()`. Postgresql uses
+        DISTINCT ON, other vendors number the rows with ROW_NUMBER().
+
+        """
+        c = self.clone()
+        c.parser.distinct_on_src = source
+        return c
+
+    def top_per_group(self, partition: str, order: str = None, n: int = 1):
+        """Return the first n rows by order of each group of partition.
+
+        The rows are numbered with ROW_NUMBER() OVER (PARTITION BY
+        partition ORDER BY order) in a subquery so that all groups are
+        selected in one query.
+
+        """
+        c = self.clone()
+        c.parser.top_per_group_src = (partition, order, n)
+        return c
+
+    def rollup(self, source: str):
+        """Group by the expressions of source and by their prefixes down to a total.
+
+        `rollup("publisher.name, genre")` adds subtotals per publisher
+        and a grand total to the groups of publisher and genre. A column
+        `grouping_<name>` for each expression is 1 in rows that total it.
+
+        """
+        c = self.clone()
+        c.parser.grouping_sets_src = ("rollup", [source])
+        return c
+
+    def cube(self, source: str):
+        """Group by all combinations of the expressions of source."""
+        c = self.clone()
+        c.parser.grouping_sets_src = ("cube", [source])
+        return c
+
+    def grouping_sets(self, sets: List[str]):
+        """Group by each of the sets of expressions, "" being the grand total."""
+        c = self.clone()
+        c.parser.grouping_sets_src = ("sets", list(sets))
+        return c
+
+    def recursive(self, parent_field: str, start=None, max_depth: int = None):
+        """Return the rows of the trees under the start rows of a hierarchy.
+
+        parent_field is a foreign key of the model to itself. start is
+        a condition like `"name == 'Science'"` or the primary key of
+        the row to start from, by default rows without a parent.
+        Descendants up to max_depth levels below the start rows are
+        walked with WITH RECURSIVE in one statement. The columns
+        `depth`, 0 for start rows, and `path`, the primary keys from
+        the start row separated by "/", are added to the select. Rows
+        are ordered by path unless ordered otherwise.
+
+        """
+        c = self.clone()
+        c.parser.recursive_src = (parent_field, start, max_depth)
+        return c
+
+    def set_operation(self, operator: str, other: "DjaqQuery"):
+        c = self.clone()
+        c.parser.set_operations.append((operator, other.parser.clone()))
+        return c
+
+    def union(self, other: "DjaqQuery", all: bool = False):
+        """Return the rows of self and of other, with duplicates unless all is False.
+
+        ORDER BY, LIMIT and OFFSET of self apply to the result, ordering
+        by expressions of the select of self.
+
+        """
+        return self.set_operation("UNION ALL" if all else "UNION", other)
+
+    def intersect(self, other: "DjaqQuery", all: bool = False):
+        """Return the rows of self that are also rows of other."""
+        return self.set_operation("INTERSECT ALL" if all else "INTERSECT", other)
+
+    def difference(self, other: "DjaqQuery", all: bool = False):
+        """Return the rows of self that are not rows of other."""
+        return self.set_operation("EXCEPT ALL" if all else "EXCEPT", other)
+
+    def fill_gaps(self, start=None, end=None):
+        """Return a row for every bucket() between start and end.
+
+        The query must group by a single `bucket()` like
+        `"bucket(pubdate, 'month'), count(id)"`. Buckets without rows
+        are returned with counts and sums of 0 and other aggregates
+        NULL. start and end default to the first and last bucket with
+        rows. The rows are ordered by the bucket.
+
+        """
+        c = self.clone()
+        c.parser.fill_gaps_src = (start, end)
+        return c
+
+    def materialize(self, materialize: bool = True):
+        """Emit named sources referenced more than once as MATERIALIZED CTEs.
+
+        Only Postgresql supports this, other vendors ignore it.
+
+        """
+        c = self.clone()
+        c.parser.materialize_ctes = materialize
+        return c
+
+    def timeout(self, seconds: float):
+        """Cancel the query if it runs longer than seconds."""
+        c = self.clone()
+        c.parser._timeout = seconds
+        return c
+
     def context(self, context: Dict, drop_empty=False):
         """Update our context with dict context."""
         c = self.clone()
@@ -1493,8 +3808,13 @@ class DjaqQuery:
         return self.parser.objs(data)
 
     def value(self, data=None):
-        # self.construct()
-        return self.parser.value(data)
+        # only the first row is fetched
+        return self.limited(1).parser.value(data)
+
+    def explain(self, data=None):
+        """Return the query plan estimate, or None if the vendor has none."""
+        self.construct()
+        return self.parser.explain(data)
 
     def dataframe(self, context=None):
         """Return a pandas dataframe.
@@ -1505,15 +3825,48 @@ class DjaqQuery:
 
         self.construct()
         self.context(context)
-        constructed_sql = self.parser.sql
-        sql = self.parser.mogrify(constructed_sql, self.parser._context)
+        sql, params = self.parser.bind_collections(
+            self.parser.sql, self.parser.sql_parameters()
+        )
+        sql = self.parser.mogrify(sql, params)
         df = pd.read_sql(sql, self.parser.connection)
         df.columns = self.parser.column_headers
+        for i, choices in self.parser.display_choices.items():
+            df[df.columns[i]] = df[df.columns[i]].map(choices)
         return df
 
+    def resolve_expression(self, *args, **kwargs):
+        """Let a QuerySet use us as a subquery like `filter(id__in=dq)`."""
+        return self
+
+    def as_sql(self, compiler, connection):
+        """Return SQL and list of parameters for a QuerySet that uses us.
+
+        We are compiled with the QuerySet instead of being executed first,
+        for its database. Collections are bound as parameters, not loaded
+        into temp tables, as the QuerySet might be run later or elsewhere.
+
+        """
+        parser = self.parser.clone(connection.alias)
+        sql, _ = parser.query()
+        sql, params = parser.bind_collections(
+            sql, parser.sql_parameters(), temp_tables=False
+        )
+        values = []
+
+        def positional(m):
+            values.append(params[m.group(1)])
+            return "%s"
+
+        return f"({re.sub(PARAMETER_PATTERN, positional, sql)})", values
+
     def qs(self):
         self.construct()
-        return self.parser.model.objects.raw(self.sql(), self.parser._context)
+        # the raw QuerySet runs later, after we could drop a temp table
+        sql, params = self.parser.bind_collections(
+            self.sql(), self.parser.sql_parameters(), temp_tables=False
+        )
+        return self.parser.model.objects.raw(sql, params)
 
     def go(self):
         return list(self.rewind().dicts())
@@ -1523,12 +3876,7 @@ class DjaqQuery:
         if result_type is a function, the function will receive a dict as a single parameter.
         """
         self.construct()
-        if not self.parser.cursor:
-            self.parser.execute(data)
-        while True:
-            row = self.parser.cursor.fetchone()
-            if row is None:
-                break
+        for row in self.parser.rows(data):
             row_dict = dict(zip(self.parser.column_headers, row))
             if dataclasses.is_dataclass(result_type):
                 yield dataclass_mapper(result_type, row_dict)
@@ -1,6 +1,7 @@
 """Result class
 Thanks to http://code.activestate.com/recipes/577887-a-simple-namespace-class/
 """
+
 from collections.abc import Mapping, Sequence
 
 
@@ -12,15 +13,79 @@ CLASS_ATTRS = dir(_Dummy)
 del _Dummy
 
 
+class DeferredChunk:
+    """Rows fetched together whose deferred fields are loaded together.
+
+    load is a function that returns a dict of the deferred fields by
+    primary key for a list of primary keys.
+
+    """
+
+    def __init__(self, load, pk, fields, pks):
+        self.load = load
+        self.pk = pk
+        self.fields = fields
+        self.pks = pks
+        self.values = None
+
+    def value(self, row, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        if self.values is None:
+            self.values = self.load(self.pks)
+        value = self.values[row[self.pk]][key]
+        row[key] = value
+        return value
+
+    def complete(self, row):
+        """Return a dict of row with the deferred fields loaded."""
+        row = dict(row)
+        for key in self.fields:
+            self.value(row, key)
+        return row
+
+
+class DeferredRow(dict):
+    """A result dict of which deferred fields are loaded when accessed."""
+
+    def __init__(self, obj, chunk):
+        super().__init__(obj)
+        self.chunk = chunk
+
+    def __missing__(self, key):
+        return self.chunk.value(self, key)
+
+    def __contains__(self, key):
+        return super().__contains__(key) or key in self.chunk.fields
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
 class DQResult(dict):
     """
     A class providing a namespace to DjangoQuery result attributes.
 
     """
 
-    def __init__(self, obj, dq):
+    def __init__(self, obj, dq, chunk=None):
         super().__init__(obj)
         self.dq = dq
+        # an attribute, not an item
+        DQResult.setattr(self, "chunk", chunk)
+
+    def __missing__(self, key):
+        chunk = DQResult.getattr(self, "chunk")
+        if chunk is None:
+            raise KeyError(key)
+        return chunk.value(self, key)
+
+    def __contains__(self, key):
+        chunk = DQResult.getattr(self, "chunk")
+        return super().__contains__(key) or bool(chunk and key in chunk.fields)
 
     def __dir__(self):
         return tuple(self)
@@ -0,0 +1,146 @@
+"""Full-text search for the `search()` and `rank()` Djaq functions.
+
+On Postgresql, `search(name, 'dog')` compiles to a match of
+`to_tsvector()` with `websearch_to_tsquery()`, which can use a GIN
+index on the same `to_tsvector()` expression. On SQLite, it compiles
+to an FTS5 MATCH against a shadow table of the column that is kept up
+to date by triggers. Other vendors fall back to a case insensitive
+substring match.
+
+`create_search_index()` creates the supporting index or shadow table.
+
+"""
+
+import re
+
+from django.conf import settings
+from django.db import connections
+
+from djaq.app_utils import get_model_from_table
+
+DEFAULT_SEARCH_CONFIG = "english"
+
+# a column expression like "books_book"."name"
+COLUMN_PATTERN = re.compile(r'"(\w+)"\."(\w+)"')
+
+
+def search_config():
+    """Return the Postgresql text search configuration to use."""
+    config = getattr(settings, "DJAQ_SEARCH_CONFIG", DEFAULT_SEARCH_CONFIG)
+    # it is written into the SQL so that it matches the index expression
+    if not re.fullmatch(r"\w+", config):
+        raise ValueError(f"Invalid DJAQ_SEARCH_CONFIG: {config}")
+    return config
+
+
+def index_name(table, column):
+    """Return the name of the GIN index or FTS5 table for a column."""
+    return f"djaq_search_{table}_{column}"
+
+
+def tsvector(column):
+    """Return the tsvector expression that the GIN index is built on."""
+    return f"to_tsvector('{search_config()}', {column})"
+
+
+def tsquery(query):
+    return f"websearch_to_tsquery('{search_config()}', {query})"
+
+
+def split_column(column):
+    """Return table and column of a column expression."""
+    m = COLUMN_PATTERN.fullmatch(column)
+    if not m:
+        raise ValueError(f"search() needs a column of a model, not: {column}")
+    return m.group(1), m.group(2)
+
+
+def fts_match(column):
+    """Return the SQLite FTS5 table and the rowid column to match for column."""
+    table, name = split_column(column)
+    model = get_model_from_table(table)
+    fts = index_name(table, name)
+    return fts, f'"{table}"."{model._meta.pk.column}"'
+
+
+def postgresql_search(funcname, args):
+    if funcname == "RANK":
+        return f"ts_rank({tsvector(args[0])}, {tsquery(args[1])})"
+    return f"{tsvector(args[0])} @@ {tsquery(args[1])}"
+
+
+def sqlite_search(funcname, args):
+    fts, rowid = fts_match(args[0])
+    if funcname == "RANK":
+        # bm25() is smaller for better matches
+        return (
+            f"(SELECT -bm25({fts}) FROM {fts} "
+            f"WHERE {fts} MATCH {args[1]} AND rowid = {rowid})"
+        )
+    return f"{rowid} IN (SELECT rowid FROM {fts} WHERE {fts} MATCH {args[1]})"
+
+
+def like_search(funcname, args):
+    if funcname == "RANK":
+        return "1"
+    return f"lower({args[0]}) LIKE '%%' || lower({args[1]}) || '%%'"
+
+
+def postgresql_ddl(table, column, pk):
+    name = index_name(table, column)
+    expression = tsvector(f'"{column}"')
+    return [f'CREATE INDEX IF NOT EXISTS {name} ON "{table}" USING gin ({expression})']
+
+
+def sqlite_ddl(table, column, pk):
+    fts = index_name(table, column)
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+        f"\"{column}\", content='{table}', content_rowid='{pk}')",
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON "{table}" BEGIN '
+        f'INSERT INTO {fts}(rowid, "{column}") VALUES (new."{pk}", new."{column}"); '
+        "END",
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON "{table}" BEGIN '
+        f'INSERT INTO {fts}({fts}, rowid, "{column}") '
+        f'VALUES (\'delete\', old."{pk}", old."{column}"); '
+        "END",
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE ON "{table}" BEGIN '
+        f'INSERT INTO {fts}({fts}, rowid, "{column}") '
+        f'VALUES (\'delete\', old."{pk}", old."{column}"); '
+        f'INSERT INTO {fts}(rowid, "{column}") VALUES (new."{pk}", new."{column}"); '
+        "END",
+        # index the rows that are already there
+        f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+    ]
+
+
+def drop_ddl(vendor, table, column):
+    name = index_name(table, column)
+    if vendor == "sqlite":
+        return [f"DROP TRIGGER IF EXISTS {name}_{t}" for t in ("ai", "ad", "au")] + [
+            f"DROP TABLE IF EXISTS {name}"
+        ]
+    return [f"DROP INDEX IF EXISTS {name}"]
+
+
+def search_index_ddl(model, field_name, vendor, drop=False):
+    """Return list of SQL statements to create the search index of a field."""
+    field = model._meta.get_field(field_name)
+    table, column, pk = model._meta.db_table, field.column, model._meta.pk.column
+    if drop:
+        return drop_ddl(vendor, table, column)
+    if vendor == "postgresql":
+        return postgresql_ddl(table, column, pk)
+    if vendor == "sqlite":
+        return sqlite_ddl(table, column, pk)
+    return []
+
+
+def create_search_index(model, field_name, using="default", drop=False):
+    """Create (or drop) the search index of a field and return the statements."""
+    connection = connections[using]
+    statements = search_index_ddl(model, field_name, connection.vendor, drop=drop)
+    with connection.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+    return statements